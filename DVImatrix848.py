@@ -18,22 +18,34 @@
 # You should have received a copy of the GNU General Public License
 # along with DVImatrix848.  If not, see <http://www.gnu.org/licenses/>.
 
+from timeline import startup
 from PySide import QtGui, QtCore
 from QtSingleApplication import QtSingleApplication
 import versions
+from communicator import communicator
+from communicator import ROUTES_REVALIDATE, ROUTES_FORCE
+from communicator import LINK_UP, LINK_RECOVERING
+from communicator import _makeRandomRoutes, _getRoutingMatrixUnparsed
+from communicator import _parseRoutingMatrixString
+import deviceprofiles
+import configuration
+from configuration import _getAppDataDir, getConfigFile
+from routingmodel import routingModel
+from portwatcher import portWatcher
+import httpapi
+import autodetect
+from broker import brokerCommunicator
 
 import os
 import sys
-import time
-import re
-import random
-
-import serial
-import serial.tools.list_ports
+import bisect
+import threading
 
 import json
 import logging
 
+startup.mark('imports')
+
 FETCHMATRIX_NEVER = 0x0
 FETCHMATRIX_AUTOMATIC = 0x1
 FETCHMATRIX_INTERACTIVE = 0x2
@@ -42,44 +54,6 @@ FETCHMATRIX_ALWAYS = FETCHMATRIX_AUTOMATIC | FETCHMATRIX_INTERACTIVE
 _SCRIPTDIR = os.path.dirname(os.path.abspath(sys.argv[0]))
 
 
-def _makeRandomRoutes():
-    routes = {}
-    for i in range(8):
-        routes[i] = random.randint(1, 8)
-    return routes
-
-
-def _getRoutingMatrixUnparsed(routes):
-    S = ['m']
-    S += ['**** MATRIX STATUS ****']
-    for o in routes:
-        i = routes[o]
-        o_ = chr(o+65)
-        s = ("Mon%s: {" % (o_))
-        s += ("DviIn=%d" % (i+1))
-        s += " , Hpd=0 , DviOutEn=0 , "
-        s += ("InDDC=%d" % (i+1))
-        s += " , DDC-Master=0 PreEmphasis=0 [db]}"
-        S += [s]
-    return '\r'.join(S)
-
-
-def _parseRoutingMatrixString(s):
-    routes = {}
-    if not s:
-        return routes
-    pat = r"^Mon(?P<output>[A-Z]+): {DviIn=(?P<input>[0-9]+) ,.*}$"
-    for x in s.split('\r'):
-        match = re.search(pat, x)
-        if match:
-            d = match.groupdict()
-            try:
-                routes[ord(d['output'])-65] = int(d['input'])-1
-            except (KeyError, TypeError, ValueError):
-                pass
-    return routes
-
-
 def _testRoutingParser():
     r0 = _makeRandomRoutes()
     rs = _getRoutingMatrixUnparsed(r0)
@@ -88,33 +62,6 @@ def _testRoutingParser():
         logging.debug("%d bytes match: %s" % (len(rs), r0))
 
 
-def _getAppDataDir():
-    appdatadir = []
-    if os.name == 'nt':
-        from win32com.shell import shellcon, shell
-        appdatadir += [shell.SHGetFolderPath(0, shellcon.CSIDL_APPDATA, 0, 0)]
-    appdatadir += [
-        os.path.join(os.path.expanduser("~"), ".config")
-        ]
-    for ad in appdatadir:
-        if os.path.exists(ad):
-            ad = os.path.join(ad, "iem.at", "DVImatrix848")
-            try:
-                os.makedirs(ad)
-            except OSError:
-                pass
-            if os.path.isdir(ad):
-                return ad
-    return None
-
-
-def getConfigFile():
-    appdatadir = _getAppDataDir()
-    if not appdatadir:
-        return
-    return os.path.join(appdatadir, "setup.json")
-
-
 def getAutostarter(name):
     try:
         from autostarterW32registry import autostarter
@@ -147,137 +94,805 @@ def getAutostarter(name):
     return ast
 
 
-class communicator(object):
-    def __init__(self, sleepTime=0):
-        super(communicator, self).__init__()
-        self.serial = None
-        self._lastTime = None
-        self.sleepTime = sleepTime
+class commRelay(QtCore.QObject):
+    # forwards notifications from a worker thread (e.g. a communicator's
+    # or the portWatcher's) into the Qt event loop (as queued signals)
+    notified = QtCore.Signal(str, object)
 
-    def send(self, data, readback=None):
-        # 'readback' controls a subsequent 'read' operation
-        # - positive ints:
-        logging.info("TODO: write '%s'" % (data))
+    def __init__(self, parent=None):
+        super(commRelay, self).__init__(parent)
 
-        # send data to the device
-        # will block if we have just opened the device
+    def forward(self, event, *args):
+        self.notified.emit(event, args)
 
-        if not self.serial or not self._lastTime:
-                return None
-        ser = self.serial
 
-        # make sure there are no left-overs in the input buffers
-        # (important for parsing readback)
-        ser.flushInput()
+class matrixWidget(QtGui.QWidget):
+    # the routing matrix as a single widget: outputs are columns,
+    # inputs are rows (with their labels in the first row/column)
+    # each cell looks like a radio button, only one per column is checked
+    # (as set in the routingModel it shows)
+    # clicking a cell emits 'routingClicked(input, output)' (once);
+    # in 'editable' mode, clicking a label emits 'labelClicked(kind, index)'
+    # (kind is 'input' or 'output')
+    routingClicked = QtCore.Signal(int, int)
+    labelClicked = QtCore.Signal(str, int)
 
-        # wait until the device has settled
-        now = time.time()
-        sleeptime = self._lastTime + self.sleepTime - now
-        logging.debug("sleeping %s seconds (%s-%s+%s)"
-                      % (sleeptime, self._lastTime, now, self.sleepTime))
-        if sleeptime > 0:
-                time.sleep(sleeptime)
-        ser.write(data)
+    def __init__(self, parent=None):
+        super(matrixWidget, self).__init__(parent)
+        self.inputs = []
+        self.outputs = []
+        self.model = None
+        self.editable = False
+        self._hover = None
+        # geometry: column/row boundaries (in pixels)
+        self._xs = [0]
+        self._ys = [0]
+        self.setMouseTracking(True)
+        self.setSizePolicy(QtGui.QSizePolicy.Minimum,
+                           QtGui.QSizePolicy.Minimum)
+
+    def setLabels(self, inputs, outputs):
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self._layout()
+        self.updateGeometry()
+        self.update()
+
+    def setEditable(self, editable=True):
+        self.editable = editable
+        self.update(self._labelsRegion())
+
+    def setModel(self, model):
+        if self.model:
+            self.model.removeListener(self._modelChanged)
+        self.model = model
+        if model:
+            model.addListener(self._modelChanged)
+        self.update()
+
+    def _modelChanged(self, event, o, old, new):
+        # only repaint the cells that have changed
+        self._dirty(o, old)
+        self._dirty(o, new)
+
+    def _layout(self):
+        # column widths follow the output labels, row heights the font
+        fm = self.fontMetrics()
+        style = self.style()
+        indicator = max(
+            style.pixelMetric(QtGui.QStyle.PM_ExclusiveIndicatorWidth),
+            style.pixelMetric(QtGui.QStyle.PM_ExclusiveIndicatorHeight))
+        pad = 6
+        cell = max(indicator, fm.height()) + pad
+        xs = [max([fm.width(s) for s in self.inputs] + [0]) + pad]
+        for s in self.outputs:
+            xs += [xs[-1] + max(cell, fm.width(s) + pad)]
+        ys = [fm.height() + pad]
+        for s in self.inputs:
+            ys += [ys[-1] + cell]
+        self._xs = xs
+        self._ys = ys
+
+    def sizeHint(self):
+        return QtCore.QSize(self._xs[-1] + 1, self._ys[-1] + 1)
+
+    def minimumSizeHint(self):
+        return self.sizeHint()
+
+    def changeEvent(self, event):
+        if event.type() in [QtCore.QEvent.FontChange,
+                            QtCore.QEvent.StyleChange]:
+            self._layout()
+            self.updateGeometry()
+        super(matrixWidget, self).changeEvent(event)
+
+    def cellRect(self, o, i):
+        # the area of a single cell (o=-1/i=-1 for the labels)
+        xs = self._xs
+        ys = self._ys
+        if o < 0:
+            x0, x1 = 0, xs[0]
+        else:
+            x0, x1 = xs[o], xs[o + 1]
+        if i < 0:
+            y0, y1 = 0, ys[0]
+        else:
+            y0, y1 = ys[i], ys[i + 1]
+        return QtCore.QRect(x0, y0, x1 - x0, y1 - y0)
 
-        ser.flush()
-        self._lastTime = time.time()
+    def _labelsRegion(self):
+        return (QtGui.QRegion(0, 0, self._xs[-1], self._ys[0]) +
+                QtGui.QRegion(0, 0, self._xs[0], self._ys[-1]))
 
-        if readback is None:
+    def _dirty(self, o, i):
+        if o is None or i is None:
+            return
+        if o in range(len(self.outputs)) and i in range(len(self.inputs)):
+            self.update(self.cellRect(o, i))
+
+    def cellAt(self, pos):
+        # hit-testing: returns (output, input) for the cell at 'pos'
+        # (-1 for the labels), or None
+        o = bisect.bisect_right(self._xs, pos.x()) - 1
+        i = bisect.bisect_right(self._ys, pos.y()) - 1
+        if o >= len(self.outputs) or i >= len(self.inputs):
             return None
-        if readback is True:
-            return ser.readline()
-        if int(readback) > 0:
-            return ser.read(int(readback))
-        return None
-
-    def connect(self, device):
-        # connects to another device
-        # if we cannot connect, this throws an exception
-        logging.info("connecting to '%s' instead of '%s'"
-                     % (device, self.getConnection()))
-        if device == self.getConnection():
+        if pos.x() < 0 or pos.y() < 0 or (o < 0 and i < 0):
+            return None
+        return (o, i)
+
+    def _cellText(self, cell):
+        (o, i) = cell
+        if o < 0:
+            return self.inputs[i]
+        if i < 0:
+            return self.outputs[o]
+        return u"%s → %s" % (self.inputs[i], self.outputs[o])
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        rect = event.rect()
+        xs = self._xs
+        ys = self._ys
+        # only the columns/rows that intersect the dirty rectangle
+        o0 = max(0, bisect.bisect_right(xs, rect.left()) - 1)
+        o1 = min(len(self.outputs), bisect.bisect_right(xs, rect.right()))
+        i0 = max(0, bisect.bisect_right(ys, rect.top()) - 1)
+        i1 = min(len(self.inputs), bisect.bisect_right(ys, rect.bottom()))
+
+        font = painter.font()
+        font.setUnderline(self.editable)
+        painter.setFont(font)
+        if rect.top() < ys[0]:
+            for o in range(o0, o1):
+                painter.drawText(self.cellRect(o, -1), QtCore.Qt.AlignCenter,
+                                 self.outputs[o])
+        if rect.left() < xs[0]:
+            for i in range(i0, i1):
+                painter.drawText(self.cellRect(-1, i),
+                                 QtCore.Qt.AlignVCenter | QtCore.Qt.AlignLeft,
+                                 self.inputs[i])
+
+        style = self.style()
+        opt = QtGui.QStyleOptionButton()
+        w = style.pixelMetric(QtGui.QStyle.PM_ExclusiveIndicatorWidth)
+        h = style.pixelMetric(QtGui.QStyle.PM_ExclusiveIndicatorHeight)
+        enabled = self.isEnabled()
+        model = self.model if self.model is not None else {}
+        for o in range(o0, o1):
+            routed = model.get(o)
+            for i in range(i0, i1):
+                r = self.cellRect(o, i)
+                opt.rect = QtCore.QRect(r.center().x() - w // 2,
+                                        r.center().y() - h // 2,
+                                        w, h)
+                state = QtGui.QStyle.State_None
+                if enabled:
+                    state |= QtGui.QStyle.State_Enabled
+                    if self._hover == (o, i):
+                        state |= QtGui.QStyle.State_MouseOver
+                if routed == i:
+                    state |= QtGui.QStyle.State_On
+                else:
+                    state |= QtGui.QStyle.State_Off
+                opt.state = state
+                style.drawPrimitive(QtGui.QStyle.PE_IndicatorRadioButton,
+                                    opt, painter, self)
+        painter.end()
+
+    def _setHover(self, cell):
+        if cell == self._hover:
             return
-        self._lastTime = None
-        self.serial = serial.Serial(
-            port=device,
-            baudrate=19200, bytesize=8, parity='N', stopbits=1,
-            timeout=1  # untested
-            )
-        # need to wait for at least 1sec until the device is usable
-        self._lastTime = time.time() + 1
-        logging.info("connected to '%s'" % self.getConnection())
-
-    def getConnection(self):
-        # gets the name of the current connection
-        # returns None if there is no open connection
-        if self.serial and self.serial.portstr:
-            return self.serial.portstr
-        return None
+        if self._hover:
+            self._dirty(*self._hover)
+        self._hover = cell
+        if cell:
+            self._dirty(*cell)
+            text = self._cellText(cell)
+        else:
+            text = ''
+        QtCore.QCoreApplication.sendEvent(self, QtGui.QStatusTipEvent(text))
+
+    def mouseMoveEvent(self, event):
+        self._setHover(self.cellAt(event.pos()))
+        super(matrixWidget, self).mouseMoveEvent(event)
+
+    def leaveEvent(self, event):
+        self._setHover(None)
+        super(matrixWidget, self).leaveEvent(event)
+
+    def mouseReleaseEvent(self, event):
+        cell = self.cellAt(event.pos())
+        if event.button() != QtCore.Qt.LeftButton or cell is None:
+            return super(matrixWidget, self).mouseReleaseEvent(event)
+        (o, i) = cell
+        if o < 0 or i < 0:
+            if self.editable:
+                if o < 0:
+                    self.labelClicked.emit('input', i)
+                else:
+                    self.labelClicked.emit('output', o)
+            return
+        if self.model is None or self.model.get(o) != i:
+            self.routingClicked.emit(i, o)
+
+    def event(self, event):
+        if event.type() == QtCore.QEvent.ToolTip:
+            cell = self.cellAt(event.pos())
+            if cell:
+                QtGui.QToolTip.showText(event.globalPos(),
+                                        self._cellText(cell), self,
+                                        self.cellRect(*cell))
+            else:
+                QtGui.QToolTip.hideText()
+                event.ignore()
+            return True
+        return super(matrixWidget, self).event(event)
+
+
+class matrixUnit(QtGui.QGroupBox):
+    # a single EXT-DVI-848: its routing state, its widgets
+    # and its own communicator (with its own I/O thread)
+    def __init__(self, main, name=None):
+        super(matrixUnit, self).__init__(main)
+        self.main = main
+        self.name = name
+        self.inputs = []
+        self.outputs = []
 
-    def route(self, input, output):
-        # tells the matrix to choose 'input' as an input for 'output'
-        # might block
-        if not self.serial:
-                return None
-        command = chr(65+output)
-        command += ('%s' % (1+input))
-        command += '\r'
-        self.send(command)
-
-    def getRoutes(self):
-        # gets all outputs with their selected inputs (as a dictionary)
-        # might block
-        if not self.serial:
-            return None
-        command = 'm\r'
-        res = self.send(command, 673)
-        d = _parseRoutingMatrixString(res)
+        # the routing (as far as we know it)
+        self.routing = routingModel()
+        # the emergency routing
+        self.defaults = routingModel()
+        # named routings (for the command line tools): {name: routes}
+        self.presets = {}
+        self.serialPorts = []  # array of name/menuitem pais
+        self.serialport = None
+        # the USB adapter of our matrix (see autodetect.fingerprint)
+        self.fingerprint = None
+        # whether to look for our matrix on the other ports,
+        # if its port is missing
+        self.autodetect = True
+        # whether the device on our port has replied like a matrix
+        self.verified = False
+        self.portFingerprints = {}  # {portname: fingerprint}
+        # the broker we talk to the matrix through (None: the serial port)
+        self.broker = None
+        self._serialConfig = None  # (as read, for when we use a broker)
+
+        self.comm = communicator(sleepTime=0.250)
+        self.commRelay = commRelay(self)
+        self.commRelay.notified.connect(self._commNotified)
+        self.comm.addListener(self.commRelay.forward)
+
+        self.serialSelections = QtGui.QActionGroup(self)
+        self.serialSelections.triggered.connect(self.selectSerialByMenu)
+
+    def readConfig(self, config, warn):
+        # the model decides on the number of inputs and outputs
+        # ('outputs'/'inputs' override it, e.g. for cascaded units)
+        try:
+            self.comm.setProfile(configuration.getProfile(config))
+        except (KeyError, TypeError, ValueError) as e:
+            self.main.status("WARNING: unknown model %s, using %s"
+                             % (e, self.comm.profile.name))
+        profile = self.comm.profile
+
+        try:
+            x = config['INPUTS']
+            if isinstance(x, list):
+                self.inputs = x
+        except KeyError:
+            warn('INPUTS')
+        try:
+            x = config['OUTPUTS']
+            if isinstance(x, list):
+                self.outputs = x
+        except KeyError:
+            warn('OUTPUTS')
+        # one label per input/output of the device
+        self.inputs = (self.inputs[:profile.inputs] +
+                       ['IN#%s' % x for x in range(len(self.inputs),
+                                                   profile.inputs)])
+        self.outputs = (self.outputs[:profile.outputs] +
+                        ['OUT#%s' % x for x in range(len(self.outputs),
+                                                     profile.outputs)])
+
+        try:
+            d = config['serial']
+            self._serialConfig = d
+            self.serialport = d.get('port', self.serialport)
+            self.fingerprint = d.get('fingerprint', self.fingerprint)
+            self.autodetect = bool(d.get('autodetect', self.autodetect))
+            configuration.configureCommunicator(self.comm, d)
+        except (KeyError, TypeError, AttributeError) as e:
+            warn('serial')
+
+        try:
+            d = config['matrix']
+            if d:
+                self.routing.update(configuration.readRoutes(d, profile),
+                                    clear=True)
+                logging.info("configmatrix: %s" % (self.routing.routes()))
+        except (KeyError, TypeError) as e:
+            warn('matrix')
+
+        try:
+            d = config['defaultmatrix']
+            if d:
+                self.defaults.update(configuration.readRoutes(d, profile),
+                                     clear=True)
+                logging.info("defaultmatrix: %s" % (self.defaults.routes()))
+        except (KeyError, TypeError) as e:
+            warn('defaultmatrix')
+
+        x = config.get('presets')
+        if isinstance(x, dict):
+            self.presets = x
+
+    def getConfig(self):
+        d = {}
+        if self.name:
+            d['name'] = self.name
+        profile = self.comm.profile
+        d['model'] = profile.name
+        default = deviceprofiles.getProfile(profile.name)
+        if profile.outputs != default.outputs:
+            d['outputs'] = profile.outputs
+        if profile.inputs != default.inputs:
+            d['inputs'] = profile.inputs
+
+        serialconf = {}
+        portname = self.comm.getConnection() or self.serialport
+        if portname:
+            serialconf['port'] = portname
+        if self.fingerprint:
+            serialconf['fingerprint'] = self.fingerprint
+        serialconf['autodetect'] = self.autodetect
+        if self.comm.sleepTime:
+                serialconf['sleep'] = self.comm.sleepTime
+        serialconf['ack'] = self.comm.useAck
+        serialconf['echo'] = self.comm.echo
+        serialconf['ackgap'] = self.comm.ackGap
+        serialconf['connectdelay'] = self.comm.connectDelay
+        serialconf['cachetime'] = self.comm.cacheTime
+        serialconf['pollinterval'] = self.comm.pollInterval
+        if self.broker and isinstance(self._serialConfig, dict):
+            # (we have not touched the serial port)
+            d['serial'] = self._serialConfig
+        elif serialconf:
+            d['serial'] = serialconf
+        logging.info("portname = '%s'\nserialconf = %s"
+                     % (portname, serialconf))
+
+        if self.inputs:
+            d['INPUTS'] = self.inputs
+        if self.outputs:
+            d['OUTPUTS'] = self.outputs
+        if self.routing:
+            d['matrix'] = self.routing.routes()
+        if self.defaults:
+            d['defaultmatrix'] = self.defaults.routes()
+        if self.presets:
+            d['presets'] = self.presets
         return d
 
+    def setupStaticUI(self):
+        self.gridLayout = QtGui.QGridLayout(self)
+        self.setTitle(self.name or "Routing matrix")
+
+        self.matrixButton = QtGui.QPushButton("Get State")
+        if self.main.whenFetchMatrix & FETCHMATRIX_INTERACTIVE:
+            self.matrixButton.setEnabled(True)
+        else:
+            self.matrixButton.setEnabled(False)
+        self.matrixButton.clicked.connect(lambda: self.getMatrix())
+        self.gridLayout.addWidget(
+            self.matrixButton,
+            0, 0,
+            1, 1,
+            QtCore.Qt.AlignLeft)
+
+        self.matrix = matrixWidget(self)
+        self.matrix.setModel(self.routing)
+        self.matrix.routingClicked.connect(self.clickedRouting)
+        self.matrix.labelClicked.connect(self.editLabel)
+        self.gridLayout.addWidget(
+            self.matrix,
+            1, 0,
+            1, 1,
+            QtCore.Qt.AlignCenter)
+
+    def setupDynamicUI(self):
+        self.matrix.setLabels(self.inputs, self.outputs)
+
+    def showLinkState(self, state):
+        # (clicks while reconnecting are applied once we are back)
+        title = self.name or "Routing matrix"
+        if state == LINK_RECOVERING:
+            title += " (reconnecting...)"
+        self.setTitle(title)
+
+    def status(self, text):
+        if self.name and len(self.main.units) > 1:
+            text = "%s: %s" % (self.name, text)
+        self.main.status(text)
+
+    def editLabels(self, state):
+        # while editing, clicking a label asks for a new one
+        self.matrix.setEditable(state)
+
+    def editLabel(self, kind, index):
+        if kind == 'input':
+            labels = self.inputs
+        else:
+            labels = self.outputs
+        (text, ok) = QtGui.QInputDialog.getText(
+            self, "Edit Labels",
+            "Label for %s #%d" % (kind, index + 1),
+            QtGui.QLineEdit.Normal, labels[index])
+        if ok and text:
+            labels[index] = text
+            self.matrix.setLabels(self.inputs, self.outputs)
+
+    def getMatrix(self, mode=ROUTES_FORCE):
+        # the result arrives asynchronously via _commNotified('routes')
+        self.comm.fetchRoutes(mode)
+
+    def _commNotified(self, event, args):
+        # called (in the GUI thread) whenever the communicator has news
+        if event == 'routes':
+            routes = args[0]
+            logging.debug("got matrix: %s" % (routes))
+            self.setRouting(routes, False)
+            if routes:
+                self.rememberPort(self.comm.getConnection())
+        elif event == 'routed':
+            # (e.g. via the HTTP API)
+            # unless a newer route for the output is on its way (e.g. the
+            # user has clicked again), which will be reported in turn
+            (i, o) = args
+            if self.comm.intendedRoutes().get(o, i) == i:
+                self.routing.set(o, i)
+        elif event == 'status':
+            # a single output, while the full 'routes' are still coming in
+            (o, i) = args
+            self.showRouting({o: i})
+        elif event == 'external':
+            # somebody else (e.g. the front panel) has changed an output
+            (o, i) = args
+            self.routing.set(o, i)
+            self.status("output %s was switched to input %s externally"
+                        % (self._outputName(o), self._inputName(i)))
+        elif event == 'connected':
+            self.status("serial port connected to %s" % (args[0]))
+            self.setEnabled(True)
+        elif event == 'link':
+            (state, recoverytime) = args
+            self.showLinkState(state)
+            if state == LINK_RECOVERING:
+                self.status("lost connection to %s, reconnecting"
+                            % (self.comm.getDevice()))
+            elif state == LINK_UP and recoverytime is not None:
+                self.status("reconnected to %s after %.1f seconds"
+                            % (self.comm.getDevice(), recoverytime))
+        elif event == 'disconnected':
+            self.status("serial port %s disconnected" % (args[0]))
+            self.verified = False
+            self.setEnabled(False)
+        elif event == 'ready':
+            self.main.unitReady(self)
+        elif event == 'error':
+            (what, err) = args
+            self.status("ERROR: %s" % (err))
+            # (unless we have already switched to another port)
+            if what == 'connect' and not self.comm.getConnection():
+                for (name, action) in self.serialPorts:
+                    action.setChecked(False)
+                self.setEnabled(False)
+
+    def _outputName(self, o):
+        try:
+            return self.outputs[o]
+        except IndexError:
+            return o
+
+    def _inputName(self, i):
+        try:
+            return self.inputs[i]
+        except IndexError:
+            return i
+
+    def setRouting(self, routes, apply=True):
+        logging.debug("setRouting: %s" % (routes))
+        if not apply:
+            # the complete routing (e.g. as read from the device)
+            self.routing.update(routes, clear=True)
+            return
+        if routes:
+            d = routes
+            self.routing.update(d)
+            # only outputs that are not already routed this way
+            # will actually be sent to the device
+            self.comm.setRoutes(d)
+            if self.main.whenFetchMatrix & FETCHMATRIX_AUTOMATIC:
+                self.getMatrix(ROUTES_REVALIDATE)
+
+    def showRouting(self, routes):
+        # (some of) the outputs have changed
+        self.routing.update(routes)
+
+    def clickedRouting(self, innum, outnum):
+        if self.routing.get(outnum) != innum:
+            self.routeInput2Output(innum, outnum)
+
+    def routeInput2Output(self, innum, outnum):
+        logging.info("%s -> %s [%s]" % (outnum, innum, self.routing.routes()))
+        self.routing.set(outnum, innum)
+        self.comm.route(innum, outnum)
+
+    def updateSerialPorts(self, added, removed, menu, taken=[],
+                          initial=False):
+        # updates 'menu' with the serial ports that have been 'added'
+        # ([(name, description, hwid)]) and 'removed' ([name]).
+        # when the port we want comes back, we reconnect to it.
+        # if we have no port (or the configured one is missing on the
+        # 'initial' scan), the first one that is not 'taken' by another
+        # unit is selected instead
+        for (name, action) in list(self.serialPorts):
+            if name not in removed:
+                continue
+            menu.removeAction(action)
+            self.serialSelections.removeAction(action)
+            self.serialPorts.remove((name, action))
+            self.portFingerprints.pop(name, None)
+            if name == self.comm.getDevice():
+                # (keeps trying until it is back)
+                self.comm.reconnect(True)
+        for (port_name, port_desc, hwid) in added:
+            self.portFingerprints[port_name] = autodetect.fingerprint(hwid)
+            action = QtGui.QAction(self)
+            action.setText(port_name)
+            action.setToolTip(port_desc)
+            action.setStatusTip("Use serial port: %s" % (port_desc))
+            action.setCheckable(True)
+            action.setActionGroup(self.serialSelections)
+            # (keep the menu sorted)
+            after = [a for (n, a) in self.serialPorts if n > port_name]
+            if after:
+                menu.insertAction(after[0], action)
+            else:
+                menu.addAction(action)
+            self.serialPorts += [(port_name, action)]
+        self.serialPorts.sort()
+
+        # our adapter might have shown up under another name
+        if self.fingerprint:
+            for (name, action) in self.serialPorts:
+                if self.portFingerprints.get(name) == self.fingerprint:
+                    if name != self.serialport:
+                        logging.info("matrix moved from %s to %s"
+                                     % (self.serialport, name))
+                    self.serialport = name
+                    break
+        for (name, action) in self.serialPorts:
+            if name == self.serialport:
+                action.setChecked(True)
+                if self.comm.getDevice() != name:
+                    self.status("serial port %s is back" % (name))
+                    self.connectSerial(name, bool(self.main.whenFetchMatrix
+                                                  & FETCHMATRIX_AUTOMATIC))
+                elif name in [p[0] for p in added]:
+                    # (don't wait for the next attempt)
+                    self.comm.reconnect()
+                return
+        if self.serialport and not initial:
+            # wait for it to come back
+            return
+        if self.autodetect:
+            self.main.autodetect([self])
+            return
+        for (name, action) in self.serialPorts:
+            if name not in taken:
+                action.setChecked(True)
+                self.selectSerial()
+                break
+
+    def selectSerial(self, portname=None, fetchMatrix=True):
+        logging.info("selectSerial: fetch=%s" % (fetchMatrix))
+        logging.info("selecting %s in %s"
+                     % (portname, [x for (x, y) in self.serialPorts]))
+        for (name, action) in self.serialPorts:
+            if portname is None:
+                selected = action.isChecked()
+            else:
+                selected = (portname == name)
+            if selected:
+                logging.info("selected serial port: %s" % (name))
+                action.setChecked(True)
+                self.connectSerial(name, fetchMatrix)
+                break
+        else:
+            if fetchMatrix:
+                self.getMatrix(ROUTES_REVALIDATE)
+
+    def connectSerial(self, name, fetchMatrix=True):
+        # connecting happens in the background;
+        # failures are reported via _commNotified('error')
+        if name != self.comm.getDevice():
+            self.verified = False
+        self.serialport = name
+        self.status("connecting to %s" % (name))
+        self.comm.connect(name, fetchMatrix)
+        self.comm.whenReady()
+
+    def useBroker(self, address, key):
+        # talk to the matrix through the broker at 'address' (see
+        # broker.py), which knows it as 'key' (its name or number),
+        # rather than opening its serial port ourselves
+        self.comm.removeListener(self.commRelay.forward)
+        self.comm.close()
+        self.comm = brokerCommunicator(address, key, self.comm.profile)
+        if isinstance(self._serialConfig, dict):
+            # (what is not configured keeps the defaults of the proxy)
+            configuration.configureCommunicator(self.comm,
+                                                self._serialConfig)
+        self.comm.addListener(self.commRelay.forward)
+        self.broker = address
+
+    def connectBroker(self, fetchMatrix=True):
+        self.status("connecting to the broker at %s" % (self.broker))
+        self.comm.connect(self.comm.device, fetchMatrix)
+        self.comm.whenReady()
+
+    def rememberPort(self, name):
+        # the device at 'name' has replied like a matrix:
+        # remember its adapter, to find it under another name next time
+        self.verified = True
+        fingerprint = self.portFingerprints.get(name)
+        if fingerprint and fingerprint != self.fingerprint:
+            logging.info("matrix on %s is %s" % (name, fingerprint))
+            self.fingerprint = fingerprint
+            self.main.configTimer.start()
+
+    def selectSerialByMenu(self):
+        wf = self.main.whenFetchMatrix
+        shouldselect = bool(wf & FETCHMATRIX_AUTOMATIC)
+        logging.info("selectSerial: %s = %s&%s"
+                     % (shouldselect, wf, FETCHMATRIX_AUTOMATIC))
+        return self.selectSerial(fetchMatrix=shouldselect)
+
+    def store(self):
+        d = self.routing.routes()
+        self.defaults.update(d, clear=True)
+        logging.info("stored default routing matrix: %s" % (d))
+        # also put it into the device's emergency slot,
+        # so restoring is a single command
+        slot = self.main.emergency_slot
+        if slot is not None:
+            try:
+                self.comm.storePreset(slot, d)
+            except (KeyError, ValueError) as e:
+                logging.info("not storing incomplete matrix in slot %s: %s"
+                             % (slot, e))
+
+    def restore(self):
+        # this only queues the commands, so restoring several units
+        # happens in parallel (each in its communicator's I/O thread)
+        routes = self.defaults.routes()
+        slot = self.main.emergency_slot
+        if slot is not None and routes:
+            # recall the routing from the device's emergency slot
+            # (the communicator programs the slot if needed, and reads
+            # back the result, which arrives as 'routes')
+            try:
+                self.comm.restorePreset(slot, routes)
+            except (KeyError, ValueError) as e:
+                logging.info("cannot use emergency slot %s: %s" % (slot, e))
+                slot = None
+        if slot is None:
+            self.setRouting(routes)
+        else:
+            self.routing.update(routes)
+        logging.info("restored default routing matrix: %s" % (routes))
+
+    def applyPreset(self, name):
+        # applies one of the named 'presets' (KeyError if there is none)
+        self.setRouting(self.routes(name))
+
+    def routes(self, key):
+        # named routings: 'defaultmatrix' or one of the 'presets'
+        if key == 'defaultmatrix':
+            return self.defaults.routes()
+        if key not in self.presets:
+            raise KeyError("no routing '%s' configured" % (key))
+        return configuration.readRoutes(self.presets[key], self.comm.profile)
+
+    def slot(self, key):
+        # the routing state slot of the device for the routing 'key'
+        # (None if it has none)
+        if key == 'defaultmatrix':
+            return self.main.emergency_slot
+        return None
+
 
 class DVImatrix848(QtGui.QMainWindow):
     def __init__(self,
                  configfile=None,
                  fetchMatrix=FETCHMATRIX_ALWAYS,
-                 restore=False
+                 restore=False,
+                 broker=None,
+                 watchPorts=True
                  ):
         super(DVImatrix848, self).__init__()
         self.whenFetchMatrix = FETCHMATRIX_NEVER
-        self.inputs = []
-        self.outputs = []
         self.configfile = None
         self.allow_emergency_store = True
-
-        self.outgroup = []
-        self.out4in = {}
-        self.default_out4in = {}
-        self.serialPorts = []  # array of name/menuitem pais
-        self.serialport = None
-
-        self.comm = communicator(sleepTime=0.250)
+        # hardware routing state slot (0..9) reserved for the emergency
+        # routing; None disables the use of the hardware slot
+        self.emergency_slot = 9
+        # where to serve the HTTP API ('[host:]port'; None to not serve it)
+        self.httpAddress = None
+        self.httpServer = None
+        # the broker to talk to the matrices through ('[host:]port';
+        # None to open the serial ports ourselves), see broker.py
+        self.brokerAddress = None
+        self._broker = broker  # (overrides the configured one)
+        # whether to watch the serial ports coming and going
+        # (and to look for the matrices on them)
+        self._watchPorts = watchPorts
+        # one matrixUnit per EXT-DVI-848
+        self.units = []
+        self._ready = False
+        self._portsScanned = False
+        # units waiting for (or during) autodetection
+        self._detectUnits = []
+        self._detecting = False
 
         if configfile is None:
             configfile = getConfigFile()
         self.whenFetchMatrix = fetchMatrix
         self.readConfig(configfile)
+        startup.mark('config')
 
-        self.serialSelections = QtGui.QActionGroup(self)
-        self.serialSelections.triggered.connect(self.selectSerialByMenu)
+        # save the configuration shortly after the routing has changed
+        self.configTimer = QtCore.QTimer(self)
+        self.configTimer.setSingleShot(True)
+        self.configTimer.setInterval(1000)
+        self.configTimer.timeout.connect(lambda: self.writeConfig())
+        for unit in self.units:
+            unit.routing.addListener(self._routingChanged)
+            unit.defaults.addListener(self._routingChanged)
 
         self.setupStaticUI()
-
-        self.rescanSerial()
-
-        self.setupDynamicUI()
-        if self.serialport:
-            self.selectSerial(self.serialport, False)
-
-        if self.whenFetchMatrix & FETCHMATRIX_AUTOMATIC:
-            self.getMatrix()
-        else:
-            logging.info("using config-matrix: %s" % (self.out4in))
-            self.setRouting(self.out4in)
-            self.showRouting(self.out4in)
+        startup.mark('static UI')
+
+        # connect right away: enumerating the ports (for the menu)
+        # can take a while, so it is done in the background
+        for unit in self.units:
+            unit.setupDynamicUI()
+            if unit.broker:
+                unit.connectBroker(False)
+            elif unit.serialport:
+                unit.connectSerial(unit.serialport, False)
+        self.portWatcher = portWatcher()
+        self.portRelay = commRelay(self)
+        self.portRelay.notified.connect(self._portsNotified)
+        self.portWatcher.addListener(self.portRelay.forward)
+        if self._watchPorts and not [u for u in self.units if u.broker]:
+            self.portWatcher.start()
+        startup.mark('dynamic UI')
+
+        if self.httpAddress is not None:
+            self.startHttpAPI(self.httpAddress)
+
+        for unit in self.units:
+            if self.whenFetchMatrix & FETCHMATRIX_AUTOMATIC:
+                unit.getMatrix(ROUTES_REVALIDATE)
+            else:
+                routes = unit.routing.routes()
+                logging.info("using config-matrix: %s" % (routes))
+                unit.setRouting(routes)
         logging.info("when: %s" % self.whenFetchMatrix)
         if restore:
             self.restore()
@@ -286,17 +901,9 @@ class DVImatrix848(QtGui.QMainWindow):
         self.resize(320, 240)
         self.centralwidget = QtGui.QWidget(self)
         self.verticalLayout = QtGui.QVBoxLayout(self.centralwidget)
-        self.groupBox = QtGui.QGroupBox(self.centralwidget)
-        self.gridLayout = QtGui.QGridLayout(self.groupBox)
-
-        self.label = QtGui.QLabel(self.groupBox)
-        self.label.setText("")
-        self.gridLayout.addWidget(
-            self.label,
-            0, 0,
-            1, 1,
-            QtCore.Qt.AlignCenter)
-        self.verticalLayout.addWidget(self.groupBox)
+        for unit in self.units:
+            unit.setupStaticUI()
+            self.verticalLayout.addWidget(unit)
         self.setCentralWidget(self.centralwidget)
 
         self.menubar = QtGui.QMenuBar(self)
@@ -307,6 +914,15 @@ class DVImatrix848(QtGui.QMainWindow):
 
         self.menuConfiguration = QtGui.QMenu(self.menubar)
         self.menuSerial_Ports = QtGui.QMenu(self.menuConfiguration)
+        # with several units, each gets its own submenu of serial ports
+        self.serialMenus = []
+        for unit in self.units:
+            if len(self.units) > 1:
+                menu = QtGui.QMenu(self.menuSerial_Ports)
+                menu.setTitle(unit.name)
+            else:
+                menu = self.menuSerial_Ports
+            self.serialMenus += [menu]
 
         self.actionStore = QtGui.QAction(self)
         self.actionStore.setText("Store")
@@ -334,6 +950,12 @@ class DVImatrix848(QtGui.QMainWindow):
 
         self.actionRescanSerial.activated.connect(self.rescanSerial)
 
+        self.actionAutodetect = QtGui.QAction(self)
+        self.actionAutodetect.setText("Autodetect")
+        self.actionAutodetect.setStatusTip(
+            "Look for the matrices on all serial ports")
+        self.actionAutodetect.activated.connect(lambda: self.autodetect())
+
         self.actionEditLabels = QtGui.QAction(self)
         self.actionEditLabels.setText("Edit Labels")
         self.actionEditLabels.setStatusTip("Edit the input/output labels")
@@ -347,8 +969,11 @@ class DVImatrix848(QtGui.QMainWindow):
         self.menuFile.addSeparator()
         self.menuFile.addAction(self.actionQuit)
         self.menuSerial_Ports.addAction(self.actionRescanSerial)
+        self.menuSerial_Ports.addAction(self.actionAutodetect)
         self.menuSerial_Ports.addSeparator()
-
+        for menu in self.serialMenus:
+            if menu is not self.menuSerial_Ports:
+                self.menuSerial_Ports.addAction(menu.menuAction())
         self.menuConfiguration.addAction(self.actionEditLabels)
         self.menuConfiguration.addAction(self.menuSerial_Ports.menuAction())
 
@@ -373,13 +998,9 @@ class DVImatrix848(QtGui.QMainWindow):
         self.menuHelp.addAction(self.actionHelp)
         self.menubar.addAction(self.menuHelp.menuAction())
 
+        # the aboutBox is only created when needed
         self.aboutBox = None
-        try:
-            self.aboutBox = aboutBox()
-        except (IOError, ValueError, KeyError) as e:
-            # couldn't initialize aboutBox, continue without
-            logging.warn("disabling ABOUT: %s" % e)
-        if self.aboutBox:
+        if os.path.exists(os.path.join(_SCRIPTDIR, 'about.json')):
             self.actionAbout = QtGui.QAction(self)
             self.actionAbout.setText("Check for updates")
             self.actionAbout.setStatusTip("Check for newer versions")
@@ -391,49 +1012,12 @@ class DVImatrix848(QtGui.QMainWindow):
 
         self.setWindowTitle("DVImatrix848")
         self.setWindowIcon(QtGui.QIcon("media/DVImatrix848.svg"))
-        self.groupBox.setTitle("Routing matrix")
         self.menuFile.setTitle("File")
         self.menuConfiguration.setTitle("Configuration")
         self.menuSerial_Ports.setTitle("Serial Ports")
-
-        self.matrixButton = QtGui.QPushButton("Get State")
-        logging.info("fetchmatrix: %s" % (self.whenFetchMatrix))
-        if self.whenFetchMatrix & FETCHMATRIX_INTERACTIVE:
-            logging.info("interactive")
-            self.matrixButton.setEnabled(True)
-        else:
-            self.matrixButton.setEnabled(False)
-        self.matrixButton.clicked.connect(self.getMatrix)
-        self.gridLayout.addWidget(
-            self.matrixButton,
-            0, 0,
-            1, 1,
-            QtCore.Qt.AlignCenter)
-
-    def setupDynamicUI(self):
-        inputs = self.inputs
-        outputs = self.outputs
-        self.outgroup = []
-
-        self.enableLabelEditing(False)
-
-        for outnum, output in enumerate(outputs):
-            outgroup = QtGui.QButtonGroup(self.groupBox)
-            self.outgroup += [outgroup]
-
-            for innum, input in enumerate(inputs):
-                butn = QtGui.QRadioButton(self.groupBox)
-                butn.setText("")
-                self.gridLayout.addWidget(
-                    butn,
-                    1+innum, 1+outnum,
-                    1, 1,
-                    QtCore.Qt.AlignCenter
-                    )
-                outgroup.addButton(butn)
-                outgroup.setId(butn, innum)
-                outgroup.buttonClicked.connect(self.clickedRouting)
-        self._updateTooltips()
+        if [unit for unit in self.units if unit.broker]:
+            # (the broker owns the serial ports)
+            self.menuSerial_Ports.setEnabled(False)
 
     def configureHotkeyMenu(self, enable=None):
         if not self.autostarter or not self.actionInstallHotkey:
@@ -458,191 +1042,117 @@ class DVImatrix848(QtGui.QMainWindow):
         self.configureHotkeyMenu()
 
     def about(self):
-        if self.aboutBox:
-            self.aboutBox.showAbout()
-
-    def _updateTooltips(self):
-        inputs = self.inputs
-        outputs = self.outputs
-        for outnum, output in enumerate(outputs):
-            for innum, input in enumerate(inputs):
-                itm = self.gridLayout.itemAtPosition(innum+1, outnum+1)
-                if itm:
-                    wdg = itm.widget()
-                    wdg.setToolTip(u"%s → %s" % (input, output))
-                    wdg.setStatusTip(u"%s → %s" % (input, output))
-
-    def _replaceWidget(self, wdg, row, col):
-        oldwdgitm = self.gridLayout.itemAtPosition(row, col)
-        if oldwdgitm:
-            oldwdg = oldwdgitm.widget()
-            self.gridLayout.removeWidget(oldwdg)
-            oldwdg.deleteLater()
-        self.gridLayout.addWidget(wdg, row, col, 1, 1, QtCore.Qt.AlignCenter)
-
-    def enableLabelEditing(self, enable=True):
-        inputs = self.inputs
-        outputs = self.outputs
-        for innum, input in enumerate(inputs):
-            if not enable:
-                inlabel = QtGui.QLabel(self.groupBox)
-            else:
-                inlabel = QtGui.QLineEdit(self.groupBox)
-            self._replaceWidget(inlabel, 1+innum, 0)
-            inlabel.setText(input)
-
-        for outnum, output in enumerate(outputs):
-            if not enable:
-                outlabel = QtGui.QLabel(self.groupBox)
-            else:
-                outlabel = QtGui.QLineEdit(self.groupBox)
-            self._replaceWidget(outlabel, 0, 1+outnum)
-            outlabel.setText(output)
-        if not enable:
-            self._updateTooltips()
+        if not self.aboutBox:
+            try:
+                self.aboutBox = aboutBox()
+            except (IOError, ValueError, KeyError) as e:
+                # couldn't initialize aboutBox, continue without
+                self.status("ERROR: cannot show ABOUT: %s" % e)
+                return
+        self.aboutBox.showAbout()
+
+    def unitReady(self, unit):
+        # a unit accepts commands
+        if not self._ready:
+            self._ready = True
+            startup.milestone("first usable route")
+
+    def _routingChanged(self, event, *args):
+        self.configTimer.start()
 
     def editLabels(self):
         state = self.actionEditLabels.isChecked()
-        if not state:
-            newouts = []
-            for idx, _ in enumerate(self.outputs):
-                itm = self.gridLayout.itemAtPosition(0, idx+1)
-                if itm and itm.widget():
-                    wdg = itm.widget()
-                    newouts += [wdg.text()]
-            newins = []
-            for idx, _ in enumerate(self.inputs):
-                itm = self.gridLayout.itemAtPosition(idx+1, 0)
-                if itm and itm.widget():
-                    wdg = itm.widget()
-                    newins += [wdg.text()]
-            self.inputs = newins
-            self.outputs = newouts
-
-        self.enableLabelEditing(state)
-
-    def getMatrix(self):
-        routes = self.comm.getRoutes()
-        logging.debug("got matrix: %s" % (routes))
-        self.setRouting(routes, False)
-
-    def setRouting(self, routes, apply=True):
-        logging.debug("setRouting: %s" % (routes))
-        for og in self.outgroup:
-            btn = og.checkedButton()
-            if btn:
-                og.setExclusive(False)
-                btn.setChecked(False)
-                og.setExclusive(True)
-        if not routes:
-            return
-        if apply:
-            d = routes
-            for o in d:
-                self.routeInput2Output(d[o], o)
-            if self.whenFetchMatrix & FETCHMATRIX_AUTOMATIC:
-                self.getMatrix()
-        else:
-            self.showRouting(routes)
-
-    def showRouting(self, routes):
-        for o in routes:
-            try:
-                i = routes[o]
-                # logging.debug("input[%s] -> output[%s]" % (i, o))
-                buttons = self.outgroup[o].buttons()
-                buttons[i].setChecked(True)
-            except IndexError:
-                pass
-
-    def clickedRouting(self, btn):
-        btngrp = btn.group()
-        innum = btngrp.checkedId()
-        outnum = -1
-        # logging.debug("outgroup: %s" % (self.outgroup))
-        for on, og in enumerate(self.outgroup):
-            # logging.debug("out[%s]=%s" % (on, og))
-            if og is btngrp:
-                outnum = on
-                break
-        if (outnum not in self.out4in) or (self.out4in[outnum] != innum):
-            self.routeInput2Output(innum, outnum)
-
-    def routeInput2Output(self, innum, outnum):
-        logging.info("%s -> %s [%s]" % (outnum, innum, self.out4in))
-        self.out4in[outnum] = innum
-        self.comm.route(innum, outnum)
-        # logging.info("TODO: connect: %s -> %s" % (innum, outnum))
+        for unit in self.units:
+            unit.editLabels(state)
 
     def rescanSerial(self):
-        lastselected = ""
-        for (name, action) in self.serialPorts:
-            if action.isChecked():
-                lastselected = name
-            self.menuSerial_Ports.removeAction(action)
-            self.serialSelections.removeAction(action)
-        self.serialPorts = []
-        for (port_name, port_desc, _) in serial.tools.list_ports.comports():
-            action = QtGui.QAction(self)
-            action.setText(port_name)
-            action.setToolTip(port_desc)
-            action.setStatusTip("Use serial port: %s" % (port_desc))
-            action.setCheckable(True)
-            action.setActionGroup(self.serialSelections)
-
-            if lastselected and lastselected == port_name:
-                action.setChecked(True)
-                lastselected = None
-
-            self.menuSerial_Ports.addAction(action)
-            self.serialPorts += [(port_name, action)]
-
-        # finally activate the correct selection
-        if lastselected is not None:
-            # this means that we were not able to continue
-            # with the old selection, so just choose the
-            # first one available
-            acts = self.serialSelections.actions()
-            if acts:
-                acts[0].setChecked(True)
-                self.selectSerial()
-
-    def selectSerial(self, portname=None, fetchMatrix=True):
-        logging.info("selectSerial: fetch=%s" % (fetchMatrix))
-        logging.info("selecting %s in %s"
-                     % (portname, [x for (x, y) in self.serialPorts]))
-        for (name, action) in self.serialPorts:
-            if portname is None:
-                selected = action.isChecked()
-            else:
-                selected = (portname == name)
-            if selected:
-                logging.info("selected serial port: %s" % (name))
-                try:
-                    self.comm.connect(name)
-                    action.setChecked(True)
-                    self.status("serial port connected to %s" % (name))
-                    self.groupBox.setEnabled(True)
-                except serial.serialutil.SerialException as e:
-                    self.status("ERROR: %s" % (e))
-                    action.setChecked(False)
-                    self.groupBox.setEnabled(False)
-                    fetchMatrix = False
-                break
-        if fetchMatrix:
-            self.getMatrix()
-
-    def selectSerialByMenu(self):
-        shouldselect = bool(self.whenFetchMatrix & FETCHMATRIX_AUTOMATIC)
-        logging.info("selectSerial: %s = %s&%s"
-                     % (shouldselect,
-                        self.whenFetchMatrix,
-                        FETCHMATRIX_AUTOMATIC))
-        return self.selectSerial(fetchMatrix=shouldselect)
+        self.portWatcher.rescan()
+
+    def _portsNotified(self, event, args):
+        # called (in the GUI thread) whenever serial ports come or go,
+        # and when autodetection is done
+        if event == 'changed':
+            self._portsChanged(*args)
+        elif event == 'detected':
+            self._detected(*args)
+
+    def _portsChanged(self, added, removed):
+        initial = not self._portsScanned
+        self._portsScanned = True
+        taken = [unit.serialport for unit in self.units]
+        for (unit, menu) in zip(self.units, self.serialMenus):
+            unit.updateSerialPorts(added, removed, menu,
+                                   [p for p in taken if p != unit.serialport],
+                                   initial)
+            taken += [unit.serialport]
+        if initial:
+            startup.mark('serial ports')
+
+    def autodetect(self, units=None):
+        # looks for the matrices of 'units' (by default: those that have
+        # not replied from their port yet) on all serial ports that are
+        # not used by other units (in the background)
+        if units is None:
+            units = [unit for unit in self.units if not unit.verified]
+        self._detectUnits += [u for u in units if u not in self._detectUnits]
+        if self._detectUnits and not self._detecting:
+            self._detecting = True
+            QtCore.QTimer.singleShot(0, self._autodetect)
+
+    def _autodetect(self):
+        units = self._detectUnits
+        self._detectUnits = []
+        busy = [unit.comm.getDevice() for unit in self.units
+                if unit not in units]
+        ports = [name for (name, desc, hwid) in self.portWatcher.ports()
+                 if name not in busy]
+        if not ports:
+            self._detected(units, {})
+            return
+        self.status("looking for matrices on %s" % (', '.join(ports)))
+        profile = max([unit.comm.profile for unit in units],
+                      key=lambda p: p.outputs)
+        delay = max([unit.comm.connectDelay for unit in units])
+
+        def run():
+            # (the ports must be free for probing)
+            for unit in units:
+                unit.comm.disconnect().wait(1)
+            found = autodetect.detect(ports, profile, connectDelay=delay)
+            self.portRelay.forward('detected', units, found)
+        thread = threading.Thread(target=run, name='autodetect')
+        thread.daemon = True
+        thread.start()
+
+    def _detected(self, units, found):
+        self._detecting = False
+        wf = self.whenFetchMatrix
+        taken = [unit.comm.getDevice() for unit in self.units
+                 if unit not in units]
+        for unit in units:
+            # prefer the port we had, and the right model
+            outputs = unit.comm.numOutputs
+            ports = sorted([p for p in found if p not in taken],
+                           key=lambda p: (p != unit.serialport,
+                                          len(found[p]) != outputs,
+                                          p))
+            if not ports:
+                unit.status("no matrix found")
+                continue
+            taken += [ports[0]]
+            unit.selectSerial(ports[0], bool(wf & FETCHMATRIX_AUTOMATIC))
+            unit.rememberPort(ports[0])
+        # (somebody might have asked in the meantime)
+        self.autodetect([])
 
     def exit(self):
         logging.info("Bye")
         self.writeConfig()
+        self.portWatcher.stop()
+        if self.httpServer:
+            self.httpServer.stop()
+        for unit in self.units:
+            unit.comm.close()
         logging.info("ByeBye")
         sys.exit()
 
@@ -652,18 +1162,69 @@ class DVImatrix848(QtGui.QMainWindow):
         self.exit()
 
     def store(self):
-        d = {}
-        for out in self.out4in:
-            d[out] = self.out4in[out]
-        self.default_out4in = d
-        logging.info("stored default routing matrix: %s"
-                     % (self.default_out4in))
+        for unit in self.units:
+            unit.store()
 
     def restore(self):
-        self.setRouting(self.default_out4in)
-        self.showRouting(self.default_out4in)
-        logging.info("restored default routing matrix: %s"
-                     % (self.default_out4in))
+        for unit in self.units:
+            unit.restore()
+
+    def startHttpAPI(self, address):
+        try:
+            (host, port) = httpapi.parseAddress(address)
+            self.httpServer = httpapi.apiServer(
+                httpapi.matrixAPI(self.units), host, port)
+        except (ValueError, EnvironmentError) as e:
+            self.status("ERROR: cannot serve HTTP API on %s: %s"
+                        % (address, e))
+            return
+        self.httpServer.start()
+        startup.mark('HTTP API')
+
+    def _selectUnits(self, name=None):
+        # all units, or the one called 'name' (or numbered 'name')
+        if name is None:
+            return self.units
+        for idx, unit in enumerate(self.units):
+            if name in [str(idx + 1), unit.name]:
+                return [unit]
+        raise ValueError("no such matrix '%s'" % (name))
+
+    def handleCommand(self, msg):
+        # executes a command (as sent by another instance), e.g.
+        #   restore [<matrix>]
+        #   route <output> <input> [<matrix>]
+        #   apply <preset> [<matrix>]
+        #   get [<matrix>]
+        # returns the reply: 'OK ...' or 'ERROR ...'
+        logging.info("command: %s" % (msg))
+        try:
+            (cmd, args, matrix) = configuration.parseCommand(msg)
+            units = self._selectUnits(matrix)
+            if cmd == 'restore':
+                for unit in units:
+                    unit.restore()
+            elif cmd == 'route':
+                unit = units[0]
+                profile = unit.comm.profile
+                o = configuration.parseOutput(args[0], unit.outputs,
+                                              profile.outputs)
+                i = configuration.parseInput(args[1], unit.inputs,
+                                             profile.inputs)
+                unit.clickedRouting(i, o)
+            elif cmd == 'apply':
+                units = [u for u in units if args[0] in u.presets]
+                if not units:
+                    return "ERROR no preset '%s'" % (args[0])
+                for unit in units:
+                    unit.applyPreset(args[0])
+            elif cmd == 'get':
+                return "OK %s" % ('; '.join(
+                    [configuration.formatRoutes(u.routing.routes(), u.name)
+                     for u in units]))
+        except ValueError as e:
+            return "ERROR %s" % (e)
+        return "OK"
 
     def readConfig(self, configfile=None):
         if not configfile:
@@ -677,8 +1238,7 @@ class DVImatrix848(QtGui.QMainWindow):
 
         config = None
         try:
-            with open(configfile, 'rb') as cf:
-                config = json.load(cf)
+            config = configuration.loadConfig(configfile)
         except (IOError, ValueError) as e:
             self.status("WARNING: configfile error: %s" % (e))
         if not config:
@@ -687,28 +1247,6 @@ class DVImatrix848(QtGui.QMainWindow):
             self.status("ERROR: illegal configfile '%s'"
                         % (configfile))
 
-        try:
-            x = config['INPUTS']
-            if isinstance(x, list):
-                self.inputs = x
-        except KeyError:
-            warn('INPUTS')
-            self.inputs = ['IN#%s' % x for x in range(8)]
-        try:
-            x = config['OUTPUTS']
-            if isinstance(x, list):
-                self.outputs = x
-        except KeyError:
-            warn('OUTPUTS')
-            self.outputs = ['OUT#%s' % x for x in range(8)]
-
-        try:
-            d = config['serial']
-            self.serialport = d.get('port', self.serialport)
-            self.comm.sleepTime = d.get('sleep', self.comm.sleepTime)
-        except (KeyError, TypeError) as e:
-            warn('serial')
-
         wf = FETCHMATRIX_ALWAYS
         try:
             d = config['generic']
@@ -730,40 +1268,25 @@ class DVImatrix848(QtGui.QMainWindow):
                     self.allow_emergency_store = False
             else:
                 warn('generic:fetchstate')
+            self.httpAddress = d.get('http')
+            self.brokerAddress = d.get('broker')
+            self.emergency_slot = configuration.getEmergencySlot(
+                config, self.emergency_slot)
 
         except (KeyError, TypeError) as e:
             warn('generic')
         self.whenFetchMatrix = wf
 
-        try:
-            d = config['matrix']
-            if d:
-                routes = {}
-                # fix the keys: we want int, not strings
-                for k in d:
-                    try:
-                        routes[int(k)] = d[k]
-                    except (ValueError):
-                        pass
-                self.out4in = routes
-                logging.info("configmatrix: %s" % (routes))
-        except (KeyError, TypeError) as e:
-            warn('matrix')
-
-        try:
-            d = config['defaultmatrix']
-            if d:
-                routes = {}
-                # fix the keys: we want int, not strings
-                for k in d:
-                    try:
-                        routes[int(k)] = d[k]
-                    except (ValueError):
-                        pass
-                self.default_out4in = routes
-                logging.info("defaultmatrix: %s" % (routes))
-        except (KeyError, TypeError) as e:
-            warn('defaultmatrix')
+        matrices = configuration.getMatrices(config)
+        self.units = []
+        for idx, d in enumerate(matrices):
+            name = configuration.getMatrixName(d, idx, len(matrices))
+            unit = matrixUnit(self, name)
+            unit.readConfig(d, warn)
+            broker = self._broker or self.brokerAddress
+            if broker:
+                unit.useBroker(broker, name or str(idx + 1))
+            self.units += [unit]
 
         self.configfile = configfile
 
@@ -785,28 +1308,18 @@ class DVImatrix848(QtGui.QMainWindow):
             whenfetch = 'interactive'
         d_generic['fetchstate'] = whenfetch
         d_generic['emergencystore'] = self.allow_emergency_store
-
+        d_generic['emergencyslot'] = self.emergency_slot
+        if self.httpAddress is not None:
+            d_generic['http'] = self.httpAddress
+        if self.brokerAddress is not None:
+            d_generic['broker'] = self.brokerAddress
+
+        if len(self.units) == 1:
+            d.update(self.units[0].getConfig())
+        else:
+            d['matrices'] = [unit.getConfig() for unit in self.units]
         d['generic'] = d_generic
-
-        serialconf = {}
-        portname = self.comm.getConnection()
-        if portname:
-            serialconf['port'] = portname
-        if self.comm.sleepTime:
-                serialconf['sleep'] = self.comm.sleepTime
-        if serialconf:
-            d['serial'] = serialconf
-        logging.info("portname = '%s'\nserialconf = %s\nconf = %s"
-                     % (portname, serialconf, d))
-
-        if self.inputs:
-            d['INPUTS'] = self.inputs
-        if self.outputs:
-            d['OUTPUTS'] = self.outputs
-        if self.out4in:
-            d['matrix'] = self.out4in
-        if self.default_out4in:
-            d['defaultmatrix'] = self.default_out4in
+        logging.info("conf = %s" % (d))
 
         with open(configfile, 'wb') as cf:
             json.dump(d, cf,
@@ -824,8 +1337,12 @@ class DVImatrix848(QtGui.QMainWindow):
 
 
 class aboutBox(QtGui.QDialog):
+    # the result of the (background) check for a new release
+    versionChecked = QtCore.Signal(object)
+
     def __init__(self):
         super(aboutBox, self).__init__()
+        self.current_version = None
 
         jsonfile = os.path.join(_SCRIPTDIR, 'about.json')
         j = None
@@ -856,6 +1373,7 @@ class aboutBox(QtGui.QDialog):
             QtCore.SIGNAL("rejected()"),
             self.reject)
         QtCore.QMetaObject.connectSlotsByName(self)
+        self.versionChecked.connect(self._versionChecked)
 
     def set(self, current_version=None, github_version=None):
         self.setWindowTitle("About DVImatrix848")
@@ -878,16 +1396,26 @@ class aboutBox(QtGui.QDialog):
                 )
 
     def showAbout(self):
-        current_version = versions.getCurrentVersion()
-        github_version = versions.getGithubVersion("iem-projects/DVImatrix848")
-        print("version: %s [%s]" % (current_version, github_version))
-        self.set(current_version, github_version)
+        # show what we know right away, and check for news in the background
+        project = "iem-projects/DVImatrix848"
+        self.current_version = versions.getCurrentVersion()
+        github_version = versions.getCachedVersion(project)
+        self.set(self.current_version, github_version)
         self.show()
+        if not versions.getCachedVersion(project, versions.CACHE_TTL):
+            versions.checkGithubVersion(project, self.versionChecked.emit)
+
+    def _versionChecked(self, github_version):
+        logging.info("version: %s [%s]"
+                     % (self.current_version, github_version))
+        if github_version:
+            self.set(self.current_version, github_version)
 
 
 def printVersion(name):
     current_version = versions.getCurrentVersion()
-    github_version = versions.getGithubVersion("iem-projects/DVImatrix848")
+    github_version = versions.getGithubVersion("iem-projects/DVImatrix848",
+                                               timeout=3)
     versionstring = ''
     if current_version:
         versionstring += (" %s" % (current_version))
@@ -907,6 +1435,12 @@ def parseCmdlineArgs():
                         help="Configuration file to read")
     parser.add_argument('-r', '--restore', action='store_true',
                         help="Restore emergency routing at startup")
+    parser.add_argument('-x', '--command', type=str,
+                        help="Execute a command (e.g. 'route B 3'),"
+                        " in the already running instance if there is one")
+    parser.add_argument('-b', '--broker', type=str,
+                        help="talk to the matrices through the broker"
+                        " listening on [host:]port (see broker.py)")
     parser.add_argument('-V', '--version', action='store_true',
                         help="print program version and exit")
     parser.add_argument('-L', '--logfile', type=str,
@@ -929,9 +1463,18 @@ if __name__ == '__main__':
     #         'github.com/iem-projects/DVImatrix848'))
     appGuid = '78cf6144-49c4-5a01-ade8-db93316aff6c'
 
+    args = parseCmdlineArgs()
     app = QtSingleApplication(appGuid, sys.argv)
+    startup.mark('single instance')
     if app.isRunning():
-        sys.exit(0)
+        # let the running instance do the work
+        command = args.command
+        if not command:
+            command = 'restore' if args.restore else 'activate'
+        reply = app.sendCommand(command)
+        if reply:
+            print(reply)
+        sys.exit(0 if reply and reply.startswith('OK') else 1)
 
     # make sure that all messages go to stderr
     # (on w32, stderr is caught automatically, whereas stdout is discarded)
@@ -944,7 +1487,6 @@ if __name__ == '__main__':
                 hasattr(sys, "importers")      # old py2exe
                 or imp.is_frozen("__main__"))  # tools/freeze
 
-    args = parseCmdlineArgs()
     if args.logfile is None:
         if is_frozen:
             appdatadir = _getAppDataDir()
@@ -970,11 +1512,21 @@ if __name__ == '__main__':
         printVersion(sys.argv[0])
         sys.exit(0)
 
+    startup.mark('logging')
     window = DVImatrix848(
         fetchMatrix=FETCHMATRIX_NEVER,
         configfile=args.config,
-        restore=args.restore)
+        restore=args.restore,
+        broker=args.broker)
     app.setActivationWindow(window)
+    app.setCommandHandler(window.handleCommand)
     window.show()
+    startup.mark('show')
+    # the window becomes visible once the event loop is running
+    QtCore.QTimer.singleShot(
+        0, lambda: startup.milestone("first visible window"))
+    if args.command:
+        logging.warn("%s: %s" % (args.command,
+                                 window.handleCommand(args.command)))
     # Run the main Qt loop
     sys.exit(app.exec_())
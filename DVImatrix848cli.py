@@ -0,0 +1,244 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014-2015, IOhannes m zmölnig, IEM
+
+# This file is part of DVImatrix848
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DVImatrix848.  If not, see <http://www.gnu.org/licenses/>.
+
+# headless control of the matrices configured in setup.json
+# (e.g. from show-control scripts):
+#    DVImatrix848cli.py route B 3
+#    DVImatrix848cli.py get
+#    DVImatrix848cli.py apply <preset>
+#    DVImatrix848cli.py restore
+# with '-b <port>', the commands go to a running broker (see broker.py)
+# rather than to the serial ports
+#
+# this must start fast: so no Qt (and nothing else that is not needed)
+
+import sys
+import pipes
+import logging
+
+import configuration
+import autodetect
+from communicator import communicator
+from portwatcher import listPorts
+
+
+class cliUnit(object):
+    # a single matrix as configured in setup.json
+    def __init__(self, config, name=None):
+        super(cliUnit, self).__init__()
+        self.config = config
+        self.name = name
+        self.profile = configuration.getProfile(config)
+        self.inputs = config.get('INPUTS') or []
+        self.outputs = config.get('OUTPUTS') or []
+        self.presets = config.get('presets') or {}
+        # the routing state slot for the emergency routing (if any)
+        self.emergencySlot = None
+        serialconf = config.get('serial') or {}
+        self.port = serialconf.get('port')
+        self.fingerprint = serialconf.get('fingerprint')
+        self.comm = communicator(sleepTime=0.250, profile=self.profile)
+        configuration.configureCommunicator(self.comm, serialconf)
+        self.errors = []
+        self.comm.addListener(self._notified)
+
+    def _notified(self, event, *args):
+        if event == 'error':
+            (what, err) = args
+            self.errors += ["%s: %s" % (what, err)]
+
+    def routes(self, key):
+        # named routings: 'defaultmatrix' or one of the 'presets'
+        if key == 'defaultmatrix':
+            d = self.config.get(key)
+        else:
+            d = self.presets.get(key)
+        if not isinstance(d, dict):
+            raise KeyError("no routing '%s' configured" % (key))
+        return configuration.readRoutes(d, self.profile)
+
+    def slot(self, key):
+        # the routing state slot of the device for the routing 'key'
+        # (None if it has none)
+        if key == 'defaultmatrix':
+            return self.emergencySlot
+        return None
+
+    def output(self, s):
+        return configuration.parseOutput(s, self.outputs,
+                                         self.profile.outputs)
+
+    def input(self, s):
+        return configuration.parseInput(s, self.inputs, self.profile.inputs)
+
+    def format(self, routes):
+        return configuration.formatRoutes(routes, self.name)
+
+
+def getUnits(configfile, selected=None, port=None):
+    config = configuration.loadConfig(configfile)
+    matrices = configuration.getMatrices(config)
+    slot = configuration.getEmergencySlot(config)
+    units = []
+    for idx, d in enumerate(matrices):
+        name = configuration.getMatrixName(d, idx, len(matrices))
+        if selected is not None and selected not in [str(idx + 1), name]:
+            continue
+        unit = cliUnit(d, name)
+        unit.emergencySlot = slot
+        units += [unit]
+    if not units:
+        raise KeyError("no such matrix '%s'" % (selected))
+    if port:
+        units[0].port = port
+    elif [unit for unit in units if unit.fingerprint]:
+        # the adapters might have shown up under other names
+        for (name, desc, hwid) in listPorts().values():
+            for unit in units:
+                if unit.fingerprint == autodetect.fingerprint(hwid):
+                    unit.port = name
+    return units
+
+
+def runBroker(args):
+    # sends the command to the broker; returns the exit code
+    import broker
+    if args.command == 'route':
+        cmd = [args.command, args.output, args.input]
+    elif args.command == 'apply':
+        cmd = [args.command, args.preset]
+    else:
+        cmd = [args.command]
+    if args.unit:
+        cmd += [args.unit]
+    msg = ' '.join([pipes.quote(x) for x in cmd])
+    reply = broker.request(args.broker, [msg], args.timeout)[0]
+    (status, _, result) = reply.partition(' ')
+    if status != 'OK':
+        logging.error("%s" % (result or reply))
+        return 1
+    if args.command == 'get':
+        for routes in result.split('; '):
+            print(routes)
+    return 0
+
+
+def run(args):
+    # returns the exit code
+    if args.broker:
+        return runBroker(args)
+    units = getUnits(args.config or configuration.getConfigFile(),
+                     args.unit, args.port)
+    if args.command == 'route':
+        units = units[:1]
+    for unit in units:
+        if not unit.port:
+            raise KeyError("no serial port configured for '%s'"
+                           % (unit.name or 'matrix'))
+
+    # check the arguments before touching any device
+    jobs = []
+    for unit in units:
+        if args.command == 'route':
+            job = (unit.input(args.input), unit.output(args.output))
+        elif args.command == 'apply':
+            job = unit.routes(args.preset)
+        elif args.command == 'restore':
+            job = unit.routes('defaultmatrix')
+        else:
+            job = None
+        jobs += [(unit, job)]
+
+    # each unit has its own communicator, so they all work in parallel
+    requests = []
+    for (unit, job) in jobs:
+        comm = unit.comm
+        comm.connect(unit.port)
+        if args.command == 'route':
+            comm.route(*job)
+        elif args.command == 'get':
+            requests += [(unit, comm.fetchRoutes())]
+        else:
+            comm.setRoutes(job)
+
+    for (unit, req) in requests:
+        routes = req.wait(args.timeout)
+        if routes:
+            print(unit.format(routes))
+    result = 0
+    for unit in units:
+        if not unit.comm.sync(args.timeout):
+            unit.errors += ["timeout"]
+        unit.comm.close()
+        for err in unit.errors:
+            logging.error("%s%s" % (unit.name + ': ' if unit.name else '',
+                                    err))
+            result = 1
+    return result
+
+
+def parseCmdlineArgs():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="control the EXT-DVI-848 matrices configured"
+        " in setup.json (without a GUI)")
+    parser.add_argument('-c', '--config', type=str,
+                        help="Configuration file to read")
+    parser.add_argument('-u', '--unit', type=str,
+                        help="only control this matrix (name or number)")
+    parser.add_argument('-p', '--port', type=str,
+                        help="use this serial port (instead of the"
+                        " configured one)")
+    parser.add_argument('-b', '--broker', type=str,
+                        help="send the command to the broker listening on"
+                        " [host:]port (instead of using the serial ports)")
+    parser.add_argument('-t', '--timeout', type=float, default=10.,
+                        help="give up after so many seconds"
+                        " (DEFAULT: %(default)s)")
+    parser.add_argument('-v', '--verbose', action='count',
+                        help="raise verbosity", default=0)
+    parser.add_argument('-q', '--quiet', action='count',
+                        help="lower verbosity", default=0)
+    commands = parser.add_subparsers(dest='command')
+    cmd = commands.add_parser('route', help="route an input to an output")
+    cmd.add_argument('output', help="output (letter, number or label)")
+    cmd.add_argument('input', help="input (number or label)")
+    commands.add_parser('get', help="print the current routing")
+    cmd = commands.add_parser('apply', help="apply a configured preset")
+    cmd.add_argument('preset', help="name of the preset")
+    commands.add_parser('restore', help="restore the emergency routing")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parseCmdlineArgs()
+    loglevel = max(0,
+                   min(logging.FATAL,
+                       logging.WARNING+(args.quiet-args.verbose)*10))
+    logging.basicConfig(level=loglevel)
+    try:
+        result = run(args)
+    except (IOError, ValueError) as e:
+        logging.error("%s" % (e))
+        result = 1
+    except KeyError as e:
+        logging.error("%s" % (e.args[0] if e.args else e))
+        result = 1
+    sys.exit(result)
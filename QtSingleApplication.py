@@ -3,9 +3,15 @@ from PySide.QtGui import *
 from PySide.QtNetwork import *
 
 
+def _readLine(socket):
+    return unicode(str(socket.readLine()), 'utf-8').rstrip(u'\r\n')
+
+
 class QtSingleApplication(QApplication):
 
     messageReceived = Signal(unicode)
+    # how long (msecs) to wait for the running instance to answer
+    connectTimeout = 500
 
     def __init__(self, id, *argv):
 
@@ -13,11 +19,13 @@ class QtSingleApplication(QApplication):
         self._id = id
         self._activationWindow = None
         self._activateOnMessage = False
+        self._commandHandler = None
 
         # Is there another instance running?
         self._outSocket = QLocalSocket()
         self._outSocket.connectToServer(self._id)
-        self._isRunning = self._outSocket.waitForConnected()
+        self._isRunning = self._outSocket.waitForConnected(
+            self.connectTimeout)
 
         if self._isRunning:
             # Yes, there is.
@@ -27,8 +35,8 @@ class QtSingleApplication(QApplication):
             # No, there isn't.
             self._outSocket = None
             self._outStream = None
-            self._inSocket = None
-            self._inStream = None
+            # all connected instances
+            self._inSockets = []
             self._server = QLocalServer()
             self._server.listen(self._id)
             self._server.newConnection.connect(self._onNewConnection)
@@ -46,6 +54,11 @@ class QtSingleApplication(QApplication):
         self._activationWindow = activationWindow
         self._activateOnMessage = activateOnMessage
 
+    def setCommandHandler(self, handler):
+        # 'handler(msg)' is called for each message from another instance;
+        # what it returns (if not None) is sent back as the reply
+        self._commandHandler = handler
+
     def activateWindow(self):
         if not self._activationWindow:
             return
@@ -61,21 +74,48 @@ class QtSingleApplication(QApplication):
         self._outStream.flush()
         return self._outSocket.waitForBytesWritten()
 
+    def sendCommand(self, msg, timeout=1000):
+        # sends 'msg' to the running instance, and returns its reply
+        # (None if there is no reply within 'timeout' msecs)
+        if not self.sendMessage(msg):
+            return None
+        timer = QElapsedTimer()
+        timer.start()
+        while not self._outSocket.canReadLine():
+            remaining = timeout - timer.elapsed()
+            if remaining <= 0:
+                return None
+            if not self._outSocket.waitForReadyRead(remaining):
+                return None
+        return _readLine(self._outSocket)
+
     def _onNewConnection(self):
-        if self._inSocket:
-            self._inSocket.readyRead.disconnect(self._onReadyRead)
-        self._inSocket = self._server.nextPendingConnection()
-        if not self._inSocket:
-            return
-        self._inStream = QTextStream(self._inSocket)
-        self._inStream.setCodec('UTF-8')
-        self._inSocket.readyRead.connect(self._onReadyRead)
-        if self._activateOnMessage:
-            self.activateWindow()
-
-    def _onReadyRead(self):
-        while True:
-            msg = self._inStream.readLine()
+        # several instances may talk to us at the same time
+        while self._server.hasPendingConnections():
+            socket = self._server.nextPendingConnection()
+            self._inSockets += [socket]
+            socket.readyRead.connect(lambda s=socket: self._onReadyRead(s))
+            socket.disconnected.connect(
+                lambda s=socket: self._onDisconnected(s))
+            # the message might have arrived already
+            self._onReadyRead(socket)
+
+    def _onDisconnected(self, socket):
+        if socket in self._inSockets:
+            self._inSockets.remove(socket)
+        socket.deleteLater()
+
+    def _onReadyRead(self, socket):
+        # (only complete lines, so nothing gets stuck in a buffer)
+        while socket.canReadLine():
+            msg = _readLine(socket)
             if not msg:
-                break
+                continue
+            if msg == 'activate' and self._activateOnMessage:
+                self.activateWindow()
             self.messageReceived.emit(msg)
+            if self._commandHandler:
+                reply = self._commandHandler(msg)
+                if reply is not None:
+                    socket.write((reply + u'\n').encode('utf-8'))
+                    socket.flush()
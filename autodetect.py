@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014-2015, IOhannes m zmölnig, IEM
+
+# This file is part of DVImatrix848
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DVImatrix848.  If not, see <http://www.gnu.org/licenses/>.
+
+# finding the matrices among the serial ports:
+# all candidate ports are asked for their status ('m') at the same time,
+# and those that reply with a routing matrix are considered matrices.
+# USB adapters can be recognized by their fingerprint (VID:PID:serial)
+# even if they show up under another port name.
+# this module must not depend on Qt.
+
+import re
+import time
+import threading
+import logging
+
+import deviceprofiles
+from communicator import communicator, ROUTES_FORCE
+
+_HWID = re.compile(r'VID:PID=([0-9A-Fa-f]{4}):([0-9A-Fa-f]{4})'
+                   r'(?:\s+SER=(\S+))?')
+
+
+def fingerprint(hwid):
+    # 'USB VID:PID=0403:6001 SER=A1B2C3 LOCATION=1-1' -> '0403:6001:A1B2C3'
+    # returns None for ports that are not USB adapters
+    match = _HWID.search(hwid or '')
+    if not match:
+        return None
+    (vid, pid, serno) = match.groups()
+    return ':'.join([vid.lower(), pid.lower(), serno or ''])
+
+
+def probe(port, profile=None, timeout=None, connectDelay=1.):
+    # asks the device at 'port' for its routing
+    # returns the routes ({output: input}), or None if it does not
+    # reply like a matrix (within 'timeout' seconds)
+    comm = communicator(profile=profile)
+    comm.connectDelay = connectDelay
+    try:
+        comm.connect(port)
+        routes = comm.fetchRoutes(ROUTES_FORCE).wait(timeout)
+    finally:
+        comm.close()
+    return routes or None
+
+
+def detect(ports, profile=None, timeout=None, connectDelay=1.):
+    # probes all 'ports' at the same time
+    # returns {port: routes} for those that replied like a matrix
+    # within 'timeout' seconds (by default: long enough for the
+    # status of the 'profile' model)
+    if profile is None or isinstance(profile, basestring):
+        profile = deviceprofiles.getProfile(profile)
+    if timeout is None:
+        timeout = connectDelay + profile.statusTimeout() + 0.5
+    deadline = time.time() + timeout
+    results = {}
+    pending = list(ports)
+    cond = threading.Condition()
+
+    def run(port):
+        routes = None
+        try:
+            routes = probe(port, profile, deadline - time.time(),
+                           connectDelay)
+        finally:
+            with cond:
+                if routes:
+                    results[port] = routes
+                pending.remove(port)
+                cond.notify()
+
+    for port in ports:
+        thread = threading.Thread(target=run, args=(port,),
+                                  name='probe %s' % (port))
+        thread.daemon = True
+        thread.start()
+    with cond:
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logging.info("no reply from %s" % (pending))
+                break
+            cond.wait(remaining)
+        logging.info("found matrices on %s" % (sorted(results)))
+        return dict(results)
@@ -0,0 +1,398 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014-2015, IOhannes m zmölnig, IEM
+
+# This file is part of DVImatrix848
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DVImatrix848.  If not, see <http://www.gnu.org/licenses/>.
+
+# sharing the matrices between several local programs:
+# only a single process can open a serial port, so the broker owns the
+# ports (of the matrices in setup.json) and many clients send it commands
+# over a local socket:
+#    broker.py -c setup.json -l 127.0.0.1:8849
+#    DVImatrix848cli.py -b 8849 route B 3
+#
+# the protocol is line based (UTF-8), using the same commands as the
+# running application (see 'DVImatrix848 -x'):
+#    route <output> <input> [<matrix>]  -> 'OK Stage: A=1 B=3 ...'
+#    set '<output>=<input> ...' [<matrix>] -> 'OK Stage: A=1 B=3 ...'
+#    apply <preset> [<matrix>]          -> 'OK Stage: A=1 B=3 ...'
+#    restore [<matrix>]                 -> 'OK Stage: A=1 B=3 ...'
+#    get [<matrix>]                     -> 'OK Stage: A=1 ...; Booth: ...'
+#    status [<matrix>]                  -> 'OK Stage: up /dev/ttyUSB0; ...'
+# each command gets a single line in reply, starting with 'OK' or 'ERROR'.
+#
+# each client is served by its own thread, which only sends its next
+# command after the previous one is done: so there is never more than a
+# single command per client waiting in the (first-come, first-served)
+# queue of a communicator, and no client can starve the others.
+# routes that are already set are skipped, and routes to an output that
+# is still waiting to be switched replace the waiting one.
+#
+# the GUI can use the broker as well (see brokerCommunicator), so it can
+# run alongside the other clients.
+# this module must not depend on Qt.
+
+import time
+import pipes
+import socket
+import logging
+import threading
+import SocketServer
+
+import serial
+
+import configuration
+from httpapi import matrixAPI, apiError, parseAddress
+from communicator import communicator, _outputName, _outputNumber
+from communicator import _monotonic
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8849
+
+# {command: number of arguments} (each optionally followed by a matrix)
+COMMANDS = {'restore': 0, 'get': 0, 'status': 0, 'route': 2, 'set': 1,
+            'apply': 1}
+
+
+def parseRoutes(s):
+    # 'Stage: A=1 B=3' -> {0: 0, 1: 2}
+    # raises ValueError
+    routes = {}
+    for x in s.rpartition(': ')[2].split():
+        (o, _, i) = x.partition('=')
+        if not o.isalpha() or not o.isupper() or not i.isdigit():
+            raise ValueError("invalid route '%s'" % (x))
+        routes[_outputNumber(o)] = int(i) - 1
+    return routes
+
+
+class broker(object):
+    # executes the commands of the clients on 'units'
+    # (like the cliUnit: see matrixAPI, plus 'format(routes)')
+    def __init__(self, units, timeout=10.):
+        super(broker, self).__init__()
+        self.units = units
+        self.api = matrixAPI(units, timeout)
+
+    def _format(self, units):
+        # the known routes of 'units': 'Stage: A=1 B=3 ...; Booth: ...'
+        return '; '.join([unit.format(unit.comm.cachedRoutes())
+                          for unit in units])
+
+    def _jobs(self, cmd, args, units):
+        # the routes to set: [(unit, routes[, slot])]
+        if cmd == 'route':
+            unit = units[0]
+            return [(unit, {self.api._output(unit, args[0]):
+                            self.api._input(unit, args[1])})]
+        if cmd == 'set':
+            # ('B=3 C=Cam': outputs and inputs as for 'route')
+            unit = units[0]
+            routes = {}
+            for x in args[0].split():
+                (o, _, i) = x.partition('=')
+                if not o or not i:
+                    raise ValueError("invalid route '%s'" % (x))
+                routes[self.api._output(unit, o)] = self.api._input(unit, i)
+            return [(unit, routes)]
+        if cmd == 'apply':
+            units = [u for u in units if args[0] in u.presets]
+            if not units:
+                raise ValueError("no preset '%s'" % (args[0]))
+            return self.api.namedJobs(units, args[0])
+        if cmd == 'restore':
+            return self.api.namedJobs(units, 'defaultmatrix')
+        return []
+
+    def execute(self, msg):
+        # executes a single command; returns the reply: 'OK ...'/'ERROR ...'
+        try:
+            (cmd, args, matrix) = configuration.parseCommand(msg, COMMANDS)
+            units = self.api.selectUnits(matrix)
+            if cmd == 'get':
+                self.api.getRoutes(units)
+                return "OK %s" % (self._format(units))
+            if cmd == 'status':
+                return "OK %s" % ('; '.join(
+                    ['%s: %s %s' % (self.api.key(unit),
+                                    unit.comm.getLinkState(),
+                                    unit.comm.getDevice())
+                     for unit in units]))
+            jobs = self._jobs(cmd, args, units)
+            # everything has been checked: now do it
+            self.api.transaction(jobs)
+            return "OK %s" % (self._format([job[0] for job in jobs]))
+        except (ValueError, apiError) as e:
+            return "ERROR %s" % (e)
+        except KeyError as e:
+            return "ERROR %s" % (e.args[0] if e.args else e)
+
+
+class brokerHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        client = '%s:%s' % self.client_address[:2]
+        logging.info("%s: connected" % (client))
+        for line in self.rfile:
+            msg = line.decode('utf-8', 'replace').strip()
+            if not msg:
+                continue
+            reply = self.server.broker.execute(msg)
+            logging.debug("%s: %s -> %s" % (client, msg, reply))
+            self.wfile.write(reply.encode('utf-8') + '\n')
+            self.wfile.flush()
+        logging.info("%s: disconnected" % (client))
+
+
+class brokerServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, broker, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        SocketServer.TCPServer.__init__(self, (host, port), brokerHandler)
+        self.broker = broker
+        self._thread = None
+
+    def start(self):
+        # serves in the background
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='broker')
+        self._thread.daemon = True
+        self._thread.start()
+        logging.info("broker on %s:%s" % self.server_address[:2])
+
+    def stop(self):
+        if self._thread:
+            self.shutdown()
+            self._thread = None
+        self.server_close()
+
+
+class brokerError(Exception):
+    # the broker has refused a command
+    pass
+
+
+class brokerCommunicator(communicator):
+    # a communicator that talks to the matrix 'matrix' (its name or
+    # number) through the broker at 'address' ([host:]port), rather than
+    # opening the serial port itself.
+    # the link is up as long as the broker is reachable and its own link
+    # to the matrix is up; otherwise we reconnect (and replay) just like
+    # with a serial port.
+    # changes made by the other clients of the broker are found by
+    # polling, and reported as 'external'.
+    def __init__(self, address, matrix, profile=None, timeout=10.):
+        super(brokerCommunicator, self).__init__(profile=profile)
+        self.address = address
+        self.matrix = matrix
+        # how long (in seconds) to wait for the broker
+        self.timeout = timeout
+        self.connectDelay = 0.
+        self.pollInterval = 1.
+        # what to connect() to
+        self.device = '%s:%s/%s' % (parseAddress(address, DEFAULT_HOST,
+                                                 DEFAULT_PORT) + (matrix,))
+
+    def _openSerial(self, device):
+        self._closeSerial()
+        sock = socket.create_connection(
+            parseAddress(self.address, DEFAULT_HOST, DEFAULT_PORT),
+            self.timeout)
+        # (the file keeps the connection open)
+        self.serial = sock.makefile('rwb')
+        sock.close()
+        self._lastTime = _monotonic()
+        self._missedReplies = 0
+        self._linkDevice = device
+
+    def _closeSerial(self):
+        if self.serial:
+            try:
+                self.serial.close()
+            except EnvironmentError as e:
+                logging.info("closing '%s' failed: %s"
+                             % (self._linkDevice, e))
+            self.serial = None
+        self._lastTime = None
+
+    def getConnection(self):
+        if self.serial:
+            return self._linkDevice
+        return None
+
+    def _waitReady(self):
+        # (the broker paces the device)
+        pass
+
+    def _command(self, *args):
+        # sends a command for our matrix to the broker
+        # returns the routes of the matrix from the reply
+        # raises EnvironmentError if the broker is gone,
+        # serial.SerialException if the broker has lost the matrix,
+        # and brokerError if the broker refuses the command
+        msg = ' '.join([pipes.quote(x) for x in list(args) + [self.matrix]])
+        self.serial.write(msg.encode('utf-8') + '\n')
+        self.serial.flush()
+        reply = self.serial.readline()
+        if not reply:
+            raise IOError("broker at %s closed the connection"
+                          % (self.address))
+        self._lastTime = _monotonic()
+        (status, _, result) = reply.decode('utf-8').strip().partition(' ')
+        if status == 'OK':
+            return parseRoutes(result)
+        if result.startswith('link down'):
+            raise serial.SerialException(result)
+        raise brokerError(result or status)
+
+    def _merge(self, routes, ours):
+        # takes the 'routes' from a reply: changes to outputs other than
+        # 'ours' have been made by somebody else
+        for o in sorted(routes):
+            if o in ours or o not in self._routes:
+                continue
+            if self._routes[o] != routes[o]:
+                self.externalChanges.append((time.time(), o,
+                                             self._routes[o], routes[o]))
+                self.stats['externalchanges'] += 1
+                self._notify('external', o, routes[o])
+        self._routes.update(routes)
+
+    def _readRoutes(self, background=False):
+        d = self._command('get')
+        self._routes.update(d)
+        if not [o for o in range(self.numOutputs) if o not in d]:
+            self._routesTime = _monotonic()
+        return d
+
+    def _route(self, input, output):
+        if not self.serial:
+            return super(brokerCommunicator, self)._route(input, output)
+        self._merge(self._command('route', _outputName(output),
+                                  str(input + 1)),
+                    [output])
+        self._notify('routed', input, output)
+
+    def _setRoutes(self, routes):
+        if not self.serial:
+            return super(brokerCommunicator, self)._setRoutes(routes)
+        # (the broker only switches what differs)
+        self._merge(self._command('set', configuration.formatRoutes(routes)),
+                    routes)
+        for o in sorted(routes):
+            self._notify('routed', routes[o], o)
+        return routes
+
+    def _storePreset(self, id, inputs):
+        # (the broker programs the slots of the device as needed)
+        if not self.serial:
+            return super(brokerCommunicator, self)._storePreset(id, inputs)
+        routes = dict(enumerate(inputs))
+        self._presets[id] = routes
+        self._notify('stored', id, routes)
+
+    def _recallPreset(self, id):
+        if not self.serial:
+            return super(brokerCommunicator, self)._recallPreset(id)
+        if id not in self._presets:
+            raise brokerError("routing state %s is unknown" % (id))
+        self._setRoutes(self._presets[id])
+        self._notify('recalled', id)
+
+    def _restorePreset(self, id, inputs):
+        if not self.serial:
+            return super(brokerCommunicator, self)._restorePreset(id,
+                                                                  inputs)
+        self._setRoutes(dict(enumerate(inputs)))
+        return dict(self._routes)
+
+
+def request(address, commands, timeout=10.):
+    # sends the 'commands' to the broker at 'address' ([host:]port)
+    # returns the replies (one per command)
+    # raises EnvironmentError if the broker cannot be reached
+    sock = socket.create_connection(
+        parseAddress(address, DEFAULT_HOST, DEFAULT_PORT), timeout)
+    try:
+        f = sock.makefile('rwb')
+        replies = []
+        for cmd in commands:
+            f.write(cmd.encode('utf-8') + '\n')
+            f.flush()
+            reply = f.readline()
+            if not reply:
+                raise IOError("broker at %s closed the connection"
+                              % (address))
+            replies += [reply.decode('utf-8').rstrip('\r\n')]
+        f.close()
+        return replies
+    finally:
+        sock.close()
+
+
+def parseCmdlineArgs():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="share the EXT-DVI-848 matrices configured"
+        " in setup.json between several local programs")
+    parser.add_argument('-c', '--config', type=str,
+                        help="Configuration file to read")
+    parser.add_argument('-l', '--listen', type=str,
+                        help="[host:]port to listen on (DEFAULT: %s:%s)"
+                        % (DEFAULT_HOST, DEFAULT_PORT))
+    parser.add_argument('-t', '--timeout', type=float, default=10.,
+                        help="give up on a command after so many seconds"
+                        " (DEFAULT: %(default)s)")
+    parser.add_argument('-v', '--verbose', action='count',
+                        help="raise verbosity", default=0)
+    parser.add_argument('-q', '--quiet', action='count',
+                        help="lower verbosity", default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    import sys
+    from DVImatrix848cli import getUnits
+    args = parseCmdlineArgs()
+    loglevel = max(0,
+                   min(logging.FATAL,
+                       logging.WARNING+(args.quiet-args.verbose)*10))
+    logging.basicConfig(level=loglevel)
+    try:
+        units = getUnits(args.config or configuration.getConfigFile())
+        server = brokerServer(broker(units, args.timeout),
+                              *parseAddress(args.listen,
+                                            DEFAULT_HOST, DEFAULT_PORT))
+    except (IOError, ValueError) as e:
+        logging.error("%s" % (e))
+        sys.exit(1)
+    except KeyError as e:
+        logging.error("%s" % (e.args[0] if e.args else e))
+        sys.exit(1)
+    for unit in units:
+        if unit.port:
+            unit.comm.connect(unit.port)
+            # so the first commands can already skip what is set
+            unit.comm.fetchRoutes()
+    print("serving on %s:%s" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    for unit in units:
+        unit.comm.close()
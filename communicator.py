@@ -0,0 +1,1082 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014-2015, IOhannes m zmölnig, IEM
+
+# This file is part of DVImatrix848
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DVImatrix848.  If not, see <http://www.gnu.org/licenses/>.
+
+# talking to the EXT-DVI-848 via the serial line.
+# all I/O happens on a dedicated worker thread, so callers never block
+# (unless they explicitly wait for a request to finish).
+# this module must not depend on Qt.
+
+import time
+import re
+import random
+import threading
+import collections
+import logging
+
+import serial
+
+import deviceprofiles
+
+# what talking to a (broken) serial device might raise
+# (anything else is a bug, and does not break the link)
+_IOERRORS = (serial.SerialException, EnvironmentError)
+try:
+    import termios
+    _IOERRORS += (termios.error,)
+except ImportError:
+    pass
+
+try:
+    from time import monotonic as _monotonic
+except ImportError:
+    try:
+        # the 'monotonic' backport for Python2
+        from monotonic import monotonic as _monotonic
+    except ImportError:
+        # no monotonic clock available
+        _monotonic = time.time
+
+
+# a single 'MonA: {DviIn=1 , ...}' record of the matrix status
+_STATUS_RECORD = re.compile(r"Mon([A-Z]{1,3}): \{DviIn=([0-9]+) ,[^}\r\n]*\}")
+_outputNumbers = {}
+_LINEBREAK = re.compile(r"[\r\n]")
+# a status reply that has been silent for so many seconds is finished
+_STATUS_QUIET = 0.1
+
+
+def _replyKey(line):
+    # what the device repeats of a command (when echoing and when
+    # acknowledging it): functions may come back without their '#'
+    return line.strip().lstrip('#').upper()
+
+
+def _outputName(output):
+    # 0 -> 'A', 25 -> 'Z', 26 -> 'AA',...
+    name = ''
+    output += 1
+    while output > 0:
+        output, r = divmod(output - 1, 26)
+        name = chr(65 + r) + name
+    return name
+
+
+def _outputNumber(name):
+    # 'A' -> 0, 'Z' -> 25, 'AA' -> 26,...
+    number = 0
+    for c in name:
+        number = number * 26 + ord(c) - 64
+    return number - 1
+
+
+# how to answer a request for the current routes
+ROUTES_CACHED = 0      # from the cache (if it knows all outputs)
+ROUTES_REVALIDATE = 1  # from the cache, unless it is older than cacheTime
+ROUTES_FORCE = 2       # always ask the device
+
+# the state of the serial link
+LINK_DOWN = 'down'              # not connected
+LINK_UP = 'up'
+LINK_RECOVERING = 'recovering'  # broken, trying to reopen the device
+
+
+def _makeRandomRoutes(outputs=8, inputs=8):
+    routes = {}
+    for i in range(outputs):
+        routes[i] = random.randint(0, inputs - 1)
+    return routes
+
+
+def _getRoutingMatrixUnparsed(routes):
+    S = ['m']
+    S += ['**** MATRIX STATUS ****']
+    for o in routes:
+        i = routes[o]
+        o_ = _outputName(o)
+        s = ("Mon%s: {" % (o_))
+        s += ("DviIn=%d" % (i+1))
+        s += " , Hpd=0 , DviOutEn=0 , "
+        s += ("InDDC=%d" % (i+1))
+        s += " , DDC-Master=0 PreEmphasis=0 [db]}"
+        S += [s]
+    return '\r'.join(S)
+
+
+def _parseRoutingMatrixString(s):
+    # a single scan for complete 'MonX: {DviIn=N , ...}' records;
+    # incomplete records and any garbage in between are ignored
+    routes = {}
+    if not s:
+        return routes
+    for (output, input) in _STATUS_RECORD.findall(s):
+        o = _outputNumbers.get(output)
+        if o is None:
+            o = _outputNumbers[output] = _outputNumber(output)
+        routes[o] = int(input) - 1
+    return routes
+
+
+class statusParser(object):
+    # incremental parser for the matrix status:
+    # feed() it the bytes as they arrive from the device,
+    # and it returns the (output, input) pairs of all records
+    # that have been completed by this chunk
+    def __init__(self):
+        super(statusParser, self).__init__()
+        self.routes = {}
+        self._buffer = ''
+
+    def feed(self, data):
+        buf = self._buffer + data
+        found = []
+        end = 0
+        for match in _STATUS_RECORD.finditer(buf):
+            (output, input) = match.groups()
+            o = _outputNumbers.get(output)
+            if o is None:
+                o = _outputNumbers[output] = _outputNumber(output)
+            i = int(input) - 1
+            self.routes[o] = i
+            found += [(o, i)]
+            end = match.end()
+        # only keep what might still become a complete record
+        tail = buf[end:]
+        idx = tail.rfind('Mon')
+        if idx >= 0 and not [c for c in '}\r\n' if c in tail[idx:]]:
+            self._buffer = tail[idx:]
+        else:
+            self._buffer = tail[-2:]
+        return found
+
+
+class _request(object):
+    # a single job for the worker thread
+    def __init__(self, name, fun, args, key=None):
+        super(_request, self).__init__()
+        self.key = key
+        self.name = name
+        self.fun = fun
+        self.args = args
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """blocks until the request has been processed (or 'timeout' expired)
+        returns the result of the request (or None)
+        """
+        self._done.wait(timeout)
+        return self.result
+
+
+class communicator(object):
+    def __init__(self, sleepTime=0, profile=None):
+        super(communicator, self).__init__()
+        self.serial = None
+        self._lastTime = None
+        # the maximum time to wait after a command (if the device does not
+        # acknowledge it earlier)
+        self.sleepTime = sleepTime
+        # the device ignores commands for so many seconds after
+        # the serial port has been opened
+        self.connectDelay = 1.
+        # whether to consider a response from the device as 'ready'
+        self.useAck = True
+        # whether the device echoes each command right away (before it
+        # has settled): the echo is not a response
+        self.echo = True
+        # the minimum time (in seconds) between a response and the next
+        # command
+        self.ackGap = 0.
+        self._lastCommand = None
+        self._awaitingAck = False
+        self._replied = False
+        # an interrupted status reply that is still coming in:
+        # (parser, deadline)
+        self._unfinishedStatus = None
+        # the model of the device (see deviceprofiles);
+        # this also sets numOutputs, numInputs and statusTimeout
+        self.setProfile(profile)
+        self._device = None
+        # last confirmed routing of the device ({output: input});
+        # outputs we don't know about are missing
+        self._routes = {}
+        # when the device last told us about all of its routes
+        # (None if the cache is invalid)
+        self._routesTime = None
+        # how long (in seconds) the cached routes are considered fresh
+        self.cacheTime = 5.
+        # if >0, the device is polled for changes (e.g. from its front
+        # panel) whenever the line has been idle for so many seconds
+        self.pollInterval = 0
+        # the health of the serial link (see LINK_*): if writing or
+        # reading fails (or the device stops replying to status requests),
+        # the device is reopened (with exponential backoff), and the
+        # routing we wanted is replayed once it is back
+        self.linkState = LINK_DOWN
+        self.reconnectDelay = 0.5  # seconds until the first attempt
+        self.maxReconnectDelay = 30.
+        # this many status requests without a reply break the link
+        self.maxMissedReplies = 2
+        self._missedReplies = 0
+        self._linkDevice = None  # the device of the link
+        self._linkLost = None  # when the link broke
+        self._reconnectAt = None  # when to try reopening the device
+        self._backoff = self.reconnectDelay
+        self._replay = None  # the routes we want, while recovering
+        # routing state slots to (re)program once the link is back:
+        # {id: inputs}
+        self._replayStores = {}
+        # the most recent changes not caused by us:
+        # (time, output, oldinput, newinput)
+        self.externalChanges = collections.deque(maxlen=100)
+        # routing states we have stored into the device ({id: routes})
+        self._presets = {}
+
+        self._listeners = []
+        self._pending = collections.deque()
+        # pending requests that may be superseded by newer ones
+        # (e.g. routes for the same output: only the last one counts)
+        self._pendingKeys = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        self._busy = None  # the request currently being processed
+        self.stats = {
+            'coalesced': 0,
+            'skipped': 0,
+            'acked': 0,
+            'unacked': 0,
+            'readtime': None,
+            'cachehits': 0,
+            'cachemisses': 0,
+            'polls': 0,
+            'drained': 0,
+            'externalchanges': 0,
+            'linkfailures': 0,
+            'recoveries': 0,
+            'recoverytime': None,
+            }
+
+    def setProfile(self, profile=None):
+        # 'profile' is a deviceprofiles.deviceProfile or the name of one
+        # (None for the default model)
+        if profile is None or isinstance(profile, basestring):
+            profile = deviceprofiles.getProfile(profile)
+        self.profile = profile
+        self.numOutputs = profile.outputs
+        self.numInputs = profile.inputs
+        # maximum time to wait for a complete status reply
+        self.statusTimeout = profile.statusTimeout()
+
+    def addListener(self, callback):
+        # 'callback(event, *args)' is called (from the worker thread)
+        # whenever something happened:
+        # - 'connected', <device>
+        # - 'disconnected', <device>
+        # - 'ready', <device>
+        # - 'link', <state>, <recoverytime> (see LINK_*;
+        #   <recoverytime> is the number of seconds it took to get the
+        #   link up again after it broke, None otherwise)
+        # - 'routed', <input>, <output>
+        # - 'status', <output>, <input> (while reading the 'routes')
+        # - 'routes', <routes>
+        # - 'external', <output>, <input> (detected by polling)
+        # - 'stored', <id>, <routes>
+        # - 'recalled', <id>
+        # - 'error', <requestname>, <exception>
+        if callback not in self._listeners:
+            self._listeners += [callback]
+
+    def removeListener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _notify(self, event, *args):
+        for cb in self._listeners:
+            try:
+                cb(event, *args)
+            except Exception as e:
+                logging.exception("listener failed on '%s': %s" % (event, e))
+
+    def _submit(self, name, fun, *args):
+        return self._submitKeyed(None, name, fun, *args)
+
+    def _submitKeyed(self, key, name, fun, *args):
+        # if 'key' is not None and there is still a request with the same
+        # key waiting in the queue, that request is updated with the new
+        # arguments (last write wins) and returned instead
+        with self._cond:
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run,
+                                                name='communicator')
+                self._thread.daemon = True
+                self._thread.start()
+            req = self._pendingKeys.get(key) if key is not None else None
+            if req:
+                logging.debug("coalescing %s%s into %s%s"
+                              % (name, args, req.name, req.args))
+                req.args = args
+                self.stats['coalesced'] += 1
+                return req
+            req = _request(name, fun, args, key)
+            if key is not None:
+                self._pendingKeys[key] = req
+            self._pending.append(req)
+            self._cond.notify()
+        return req
+
+    def sync(self, timeout=None):
+        # blocks until all requests submitted so far have been processed
+        # returns False if 'timeout' expired before that
+        return bool(self._submit('sync', lambda: True).wait(timeout))
+
+    def pending(self):
+        # number of requests waiting to be processed
+        with self._cond:
+            return len(self._pending)
+
+    def _pollTimeout(self):
+        # seconds until the next poll is due (None if we don't poll)
+        if not self.pollInterval or not self.serial or not self._lastTime:
+            return None
+        return self._lastTime + self.pollInterval - _monotonic()
+
+    def _reconnectTimeout(self):
+        # seconds until we try to reopen the device (None if we don't)
+        if self._reconnectAt is None:
+            return None
+        return self._reconnectAt - _monotonic()
+
+    def _idleTimeout(self):
+        # seconds until there is something to do (None if never)
+        timeouts = [t for t in [self._pollTimeout(),
+                                self._reconnectTimeout()]
+                    if t is not None]
+        if not timeouts:
+            return None
+        return min(timeouts)
+
+    def setPollInterval(self, interval):
+        # poll the device every 'interval' seconds (0 to disable)
+        with self._cond:
+            self.pollInterval = interval
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            req = None
+            with self._cond:
+                while not self._pending:
+                    timeout = self._idleTimeout()
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._pending:
+                    req = self._pending.popleft()
+                    if req.key is not None:
+                        del self._pendingKeys[req.key]
+                    self._busy = req
+            if req is None:
+                timeout = self._reconnectTimeout()
+                if timeout is not None and timeout <= 0:
+                    self._reopen()
+                    continue
+                # idle for long enough: look for external changes
+                try:
+                    self._poll()
+                except _IOERRORS as e:
+                    logging.error("polling failed: %s" % (e))
+                    # don't retry before the next interval
+                    self._lastTime = _monotonic()
+                    self._linkFailed(e)
+                except Exception as e:
+                    logging.exception("polling failed: %s" % (e))
+                    self._lastTime = _monotonic()
+                continue
+            if req.fun is None:
+                req._done.set()
+                break
+            try:
+                req.result = req.fun(*req.args)
+            except _IOERRORS as e:
+                logging.error("%s failed: %s" % (req.name, e))
+                req.error = e
+                self._notify('error', req.name, e)
+                if req.name != 'connect':
+                    self._linkFailed(e)
+                    self._remember(req)
+            except Exception as e:
+                # (e.g. a garbled reply): the worker must keep running,
+                # or nobody would ever be told that their request is done
+                logging.exception("%s failed: %s" % (req.name, e))
+                req.error = e
+                self._notify('error', req.name, e)
+            finally:
+                with self._cond:
+                    self._busy = None
+                req._done.set()
+
+    def _remember(self, req):
+        # without a device, (re)running a request that failed on the link
+        # only remembers what we want (for when the device is back)
+        if self.serial or req.name not in ['route', 'setRoutes',
+                                           'storePreset', 'recallPreset',
+                                           'restorePreset']:
+            return
+        try:
+            req.fun(*req.args)
+        except Exception as e:
+            logging.exception("cannot remember %s: %s" % (req.name, e))
+
+    def close(self, timeout=10.):
+        # stops the worker thread (after all pending requests are done,
+        # but waiting no longer than 'timeout' seconds for them)
+        # and closes the serial device
+        with self._cond:
+            running = self._thread is not None
+        if running:
+            quit = self._submit('quit', None)
+            if not quit.wait(timeout) and not quit.done():
+                with self._cond:
+                    logging.warn("closing with %d requests pending"
+                                 % (len(self._pending)))
+                    # drop everything but the 'quit'
+                    self._pending.clear()
+                    self._pendingKeys.clear()
+                    self._pending.append(quit)
+                    # (so a request failing on the closed device
+                    # does not try to reopen it)
+                    self.linkState = LINK_DOWN
+                    self._reconnectAt = None
+            self._thread = None
+        if self.serial:
+            self.serial.close()
+        self.serial = None
+        self._device = None
+
+    def send(self, data, readback=None):
+        # 'readback' controls a subsequent 'read' operation
+        # - positive ints: read (up to) so many bytes
+        # - True: read a single line
+        # - callables: are called (without arguments) to do the reading
+        # only ever call this from the worker thread
+        logging.info("TODO: write '%s'" % (data))
+
+        # send data to the device
+        # will block if we have just opened the device
+
+        if not self.serial or not self._lastTime:
+                return None
+        ser = self.serial
+
+        # wait until the device has finished talking, and has settled
+        self._drainStatus()
+        self._waitReady()
+
+        # make sure there are no left-overs in the input buffers
+        # (important for parsing readback)
+        ser.flushInput()
+
+        ser.write(data)
+        self._lastCommand = data
+
+        ser.flush()
+        self._lastTime = _monotonic()
+
+        if readback is None:
+            # the response (if any) is consumed by the next _waitReady()
+            self._awaitingAck = True
+            return None
+        res = None
+        if readback is True:
+            res = ser.readline()
+        elif callable(readback):
+            res = readback()
+        elif int(readback) > 0:
+            res = ser.read(int(readback))
+        # a (complete) reply means that the device is ready again
+        self._replied = bool(res)
+        return res
+
+    def _waitReady(self):
+        # blocks until the device is ready to accept the next command:
+        # that is 'ackGap' after it has acknowledged the last command
+        # (by repeating it once it has settled, after the echo),
+        # but no longer than 'sleepTime' after the last command.
+        # any other line (status records, late replies, noise) is ignored.
+        # right after connecting, _lastTime lies in the future
+        ser = self.serial
+        now = _monotonic()
+        deadline = self._lastTime + self.sleepTime
+        if self._replied and self.useAck:
+            deadline = self._lastTime
+        elif self._awaitingAck and self.useAck and deadline > now:
+            timeout = ser.timeout
+            acked = False
+            expected = _replyKey(self._lastCommand or '')
+            # the echo (if any) comes first, the acknowledgement after it
+            replies = 2 if self.echo else 1
+            data = ''
+            try:
+                while expected and not acked:
+                    remaining = deadline - _monotonic()
+                    if remaining <= 0:
+                        break
+                    ser.timeout = remaining
+                    data += ser.read(max(1, ser.inWaiting()))
+                    lines = _LINEBREAK.split(data)
+                    data = lines.pop()
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        if _replyKey(line) != expected:
+                            logging.debug("ignoring reply %r" % (line,))
+                            continue
+                        replies -= 1
+                        if replies <= 0:
+                            acked = True
+                            break
+            finally:
+                ser.timeout = timeout
+            if acked:
+                self.stats['acked'] += 1
+                deadline = min(_monotonic() + self.ackGap, deadline)
+            else:
+                self.stats['unacked'] += 1
+        self._awaitingAck = False
+        self._replied = False
+        sleeptime = deadline - _monotonic()
+        logging.debug("sleeping %s seconds (%s+%s)"
+                      % (sleeptime, self._lastTime, self.sleepTime))
+        if sleeptime > 0:
+            time.sleep(sleeptime)
+
+    def connect(self, device, fetchRoutes=False):
+        # connects to another device (in the background)
+        # if we cannot connect, an 'error' is reported to the listeners
+        # if 'fetchRoutes' is True, the routes are read after connecting
+        self._device = device
+        return self._submit('connect', self._connect, device, fetchRoutes)
+
+    def _connect(self, device, fetchRoutes=False):
+        logging.info("connecting to '%s' instead of '%s'"
+                     % (device, self.getConnection()))
+        if device != self.getConnection():
+            if (self.linkState == LINK_RECOVERING and
+                    device == self._linkDevice):
+                # (the broken link: don't wait for the next attempt)
+                self._backoff = self.reconnectDelay
+                self._reopen()
+            else:
+                self._routes = {}
+                self._routesTime = None
+                self._presets = {}
+                self._setLinkState(LINK_DOWN)
+                self._openSerial(device)
+                self._setLinkState(LINK_UP)
+                logging.info("connected to '%s'" % self.getConnection())
+        if self.serial:
+            self._notify('connected', device)
+        if fetchRoutes:
+            return self._fetchRoutes(ROUTES_REVALIDATE)
+
+    def _openSerial(self, device):
+        self._closeSerial()
+        self.serial = serial.Serial(
+            port=device,
+            baudrate=19200, bytesize=8, parity='N', stopbits=1,
+            timeout=1  # untested
+            )
+        # need to wait (1sec) until the device is usable
+        self._lastTime = _monotonic() + self.connectDelay
+        self._awaitingAck = False
+        self._replied = False
+        self._unfinishedStatus = None
+        self._missedReplies = 0
+        self._linkDevice = device
+
+    def _closeSerial(self):
+        if self.serial:
+            try:
+                self.serial.close()
+            except _IOERRORS as e:
+                logging.info("closing '%s' failed: %s"
+                             % (self._linkDevice, e))
+            self.serial = None
+        self._lastTime = None
+
+    def _setLinkState(self, state, recoverytime=None):
+        if state != LINK_RECOVERING:
+            self._reconnectAt = None
+            self._replay = None
+            self._replayStores = {}
+        if state == self.linkState:
+            return
+        logging.info("link to '%s': %s" % (self._linkDevice, state))
+        self.linkState = state
+        self._notify('link', state, recoverytime)
+
+    def getLinkState(self):
+        return self.linkState
+
+    def _linkFailed(self, reason):
+        # the link is broken: close the device, and try to reopen it
+        # (a little later, and if that fails again, even later)
+        if self.linkState == LINK_DOWN:
+            return
+        self._closeSerial()
+        if self.linkState == LINK_UP:
+            logging.error("lost connection to '%s': %s"
+                          % (self._linkDevice, reason))
+            self.stats['linkfailures'] += 1
+            self._linkLost = _monotonic()
+            self._backoff = self.reconnectDelay
+            # what the device should do, once it is back
+            replay = dict(self._routes)
+            self.invalidate()
+            self._setLinkState(LINK_RECOVERING)
+            self._replay = replay
+        self._reconnectAt = _monotonic() + self._backoff
+        self._backoff = min(2 * self._backoff, self.maxReconnectDelay)
+
+    def _reopen(self):
+        # tries to recover the broken link:
+        # the device must reply to a status request,
+        # then all outputs that differ from what we wanted are switched
+        self._reconnectAt = None
+        device = self._linkDevice
+        try:
+            self._openSerial(device)
+            if not self._readRoutes():
+                raise serial.SerialException("no reply from '%s'" % device)
+        except _IOERRORS as e:
+            logging.info("reconnecting to '%s' failed: %s" % (device, e))
+            self._linkFailed(e)
+            return False
+        recoverytime = _monotonic() - self._linkLost
+        replay = self._replay or {}
+        stores = self._replayStores
+        self.stats['recoveries'] += 1
+        self.stats['recoverytime'] = recoverytime
+        logging.info("reconnected to '%s' after %s seconds"
+                     % (device, recoverytime))
+        self._setLinkState(LINK_UP, recoverytime)
+        try:
+            # (slots first: their routes are already part of the replay)
+            for id in sorted(stores):
+                self._storePreset(id, stores[id])
+            changed = self._diffRoutes(replay, self._routes)
+            for o in changed:
+                self._route(changed[o], o)
+        except _IOERRORS as e:
+            self._linkFailed(e)
+            # (we still want all of it)
+            if self._replay is not None:
+                self._replay.update(replay)
+                self._replayStores.update(stores)
+            return False
+        self._notify('routes', dict(self._routes))
+        return True
+
+    def reconnect(self, force=False):
+        # if the link is broken, tries to reopen the device right away
+        # (rather than waiting for the next attempt);
+        # with 'force', a working link is considered broken as well
+        # (e.g. because the device has vanished)
+        return self._submit('reconnect', self._reconnect, force)
+
+    def _reconnect(self, force=False):
+        if force and self.linkState == LINK_UP:
+            self._linkFailed("reconnect requested")
+        if self.linkState != LINK_RECOVERING:
+            return None
+        self._backoff = self.reconnectDelay
+        return self._reopen()
+
+    def disconnect(self):
+        # closes the serial device (in the background), e.g. because
+        # it has vanished; connect() to it again once it is back
+        self._device = None
+        return self._submit('disconnect', self._disconnect)
+
+    def _disconnect(self):
+        device = self.getConnection()
+        self._closeSerial()
+        self._setLinkState(LINK_DOWN)
+        self._linkDevice = None
+        self.invalidate()
+        if device:
+            self._notify('disconnected', device)
+
+    def whenReady(self):
+        # reports 'ready' (with the name of the device), as soon as
+        # the device accepts commands (e.g. after connecting)
+        return self._submit('ready', self._ready)
+
+    def _ready(self):
+        if not self.serial or not self._lastTime:
+            return False
+        self._waitReady()
+        self._notify('ready', self.getConnection())
+        return True
+
+    def getDevice(self):
+        # the device we are connected (or connecting) to
+        return self._device
+
+    def getConnection(self):
+        # gets the name of the current connection
+        # returns None if there is no open connection
+        if self.serial and self.serial.portstr:
+            return self.serial.portstr
+        return None
+
+    def route(self, input, output):
+        # tells the matrix to choose 'input' as an input for 'output'
+        # returns immediately
+        # if there is still an unsent route for 'output' in the queue,
+        # it is replaced by this one (so a burst of clicks on the same
+        # output results in a single command)
+        if output not in range(self.numOutputs):
+            raise ValueError("illegal output %r" % (output,))
+        if input not in range(self.numInputs):
+            raise ValueError("illegal input %r" % (input,))
+        return self._submitKeyed(('route', output), 'route', self._route,
+                                 input, output)
+
+    def _route(self, input, output):
+        if not self.serial:
+            if self._replay is not None:
+                self._replay[output] = input
+            return None
+        command = _outputName(output)
+        command += ('%s' % (1+input))
+        command += '\r'
+        self.send(command)
+        self._routes[output] = input
+        self._notify('routed', input, output)
+
+    def storePreset(self, id, routes):
+        # saves 'routes' into the routing state slot 'id' (0..9)
+        # of the device (using '#PSASRS'), if the model has any
+        # 'routes' must contain an input for each output
+        if id not in range(self.profile.presets):
+            raise ValueError("illegal routing state ID %r" % (id,))
+        inputs = [routes[o] for o in range(self.numOutputs)]
+        return self._submit('storePreset', self._storePreset, id, inputs)
+
+    def _storePreset(self, id, inputs):
+        if not self.serial:
+            if self._replay is not None:
+                self._replayStores[id] = inputs
+            return None
+        command = '#PSASRS %d ' % (id)
+        command += ' '.join(['%d' % (1+i) for i in inputs])
+        command += '\r'
+        self.send(command)
+        routes = dict(enumerate(inputs))
+        self._presets[id] = routes
+        self._notify('stored', id, routes)
+
+    def recallPreset(self, id):
+        # switches all outputs at once to the routing state slot 'id'
+        # (as previously saved with storePreset())
+        if id not in range(self.profile.presets):
+            raise ValueError("illegal routing state ID %r" % (id,))
+        return self._submit('recallPreset', self._recallPreset, id)
+
+    def _recallPreset(self, id):
+        if not self.serial:
+            if self._replay is None:
+                return None
+            if id in self._replayStores:
+                self._replay.update(enumerate(self._replayStores[id]))
+            elif id in self._presets:
+                self._replay.update(self._presets[id])
+            return None
+        self.send('S%d\r' % (id))
+        if id not in self._presets:
+            self.invalidate()
+        self._routes = dict(self._presets.get(id, {}))
+        self._notify('recalled', id)
+
+    def restorePreset(self, id, routes):
+        # makes the matrix use 'routes' by recalling the routing state
+        # slot 'id' (a single command for all outputs)
+        # the slot is (re)programmed first, unless we have stored 'routes'
+        # into it since connecting (somebody else might have overwritten
+        # it, or there might be another device on the port by now)
+        # afterwards the routes are read back (and fixed, if the slot did
+        # not hold what we thought)
+        # 'routes' must contain an input for each output
+        if id not in range(self.profile.presets):
+            raise ValueError("illegal routing state ID %r" % (id,))
+        inputs = [routes[o] for o in range(self.numOutputs)]
+        return self._submit('restorePreset', self._restorePreset, id, inputs)
+
+    def _restorePreset(self, id, inputs):
+        routes = dict(enumerate(inputs))
+        if not self.serial:
+            if self._replay is not None:
+                self._replay.update(routes)
+            return None
+        if self._presets.get(id) != routes:
+            self._storePreset(id, inputs)
+        self._recallPreset(id)
+        self._readRoutes()
+        changed = self._diffRoutes(routes, self._routes)
+        if changed:
+            logging.warn("routing state %s does not hold %s: switching %s"
+                         % (id, routes, changed))
+            self._presets.pop(id, None)
+            for o in changed:
+                self._route(changed[o], o)
+        self._notify('routes', dict(self._routes))
+        return dict(self._routes)
+
+    def _intendedRoutes(self):
+        # the routing the device will have once all queued requests
+        # are done (outputs with unknown state are missing)
+        # must be called with self._cond held
+        routes = dict(self._routes)
+        for req in [self._busy] + list(self._pending):
+            if not req:
+                continue
+            if req.name == 'route':
+                (i, o) = req.args
+                routes[o] = i
+            elif req.name == 'recallPreset':
+                routes = dict(self._presets.get(req.args[0], {}))
+            elif req.name == 'restorePreset':
+                routes = dict(enumerate(req.args[1]))
+            elif req.name == 'connect':
+                routes = {}
+        return routes
+
+    def intendedRoutes(self):
+        # the routing the device will have once all queued requests
+        # are done (outputs with unknown state are missing)
+        with self._cond:
+            return self._intendedRoutes()
+
+    def _diffRoutes(self, routes, current):
+        changed = {}
+        for o in routes:
+            if current.get(o) != routes[o]:
+                changed[o] = routes[o]
+        self.stats['skipped'] += len(routes) - len(changed)
+        return changed
+
+    def setRoutes(self, routes):
+        # makes the matrix use 'routes' ({output: input})
+        # only outputs that differ from the (known) state of the device
+        # are actually switched
+        # if the state of some outputs is unknown, it is read from the
+        # device before deciding what to send
+        with self._cond:
+            current = self._intendedRoutes()
+            if [o for o in routes if o not in current]:
+                last = self._pending[-1] if self._pending else None
+                if last and last.name == 'setRoutes':
+                    # still waiting for the state: merge the two
+                    last.args[0].update(routes)
+                else:
+                    self._submit('setRoutes', self._setRoutes, dict(routes))
+                return
+            changed = self._diffRoutes(routes, current)
+            logging.debug("setRoutes: %s -> %s" % (routes, changed))
+            for o in changed:
+                self.route(changed[o], o)
+
+    def _setRoutes(self, routes):
+        if not self.serial:
+            if self._replay is not None:
+                self._replay.update(routes)
+            return None
+        self._readRoutes()
+        changed = self._diffRoutes(routes, self._routes)
+        logging.debug("setRoutes: %s -> %s" % (routes, changed))
+        # switch right away (rather than queueing), so requests submitted
+        # after us see the new routing
+        for o in changed:
+            self._route(changed[o], o)
+        return changed
+
+    def invalidate(self):
+        # forget what we know about the device's routes
+        self._routes = {}
+        self._routesTime = None
+
+    def cachedRoutes(self):
+        # the routes as we currently know them (without asking the device)
+        return dict(self._routes)
+
+    def _cacheValid(self, mode):
+        if mode == ROUTES_FORCE:
+            return False
+        if [o for o in range(self.numOutputs) if o not in self._routes]:
+            return False
+        if mode == ROUTES_CACHED:
+            return True
+        if self._routesTime is None:
+            return False
+        return (_monotonic() - self._routesTime) <= self.cacheTime
+
+    def fetchRoutes(self, mode=ROUTES_FORCE):
+        # asks the matrix for its current routing
+        # returns immediately, the result is reported as 'routes'
+        # 'mode' decides whether the cached routes are good enough
+        # (ROUTES_CACHED, ROUTES_REVALIDATE) or whether the device
+        # must be asked (ROUTES_FORCE)
+        return self._submit('getRoutes', self._fetchRoutes, mode)
+
+    def _readStatus(self, timeout=None, background=False):
+        # reads (and parses) the reply to a status request,
+        # stopping as soon as the last output has been reported
+        # (rather than waiting for a fixed number of bytes)
+        # gives up after 'timeout' seconds (default: self.statusTimeout)
+        # each output is reported as 'status' as soon as it has been read,
+        # unless we are reading in the 'background' (polling), in which
+        # case we also give up as soon as other requests are waiting.
+        # returns the routes that could be parsed
+        ser = self.serial
+        if timeout is None:
+            timeout = self.statusTimeout
+        start = _monotonic()
+        deadline = start + timeout
+        lastoutput = self.numOutputs - 1
+        parser = statusParser()
+        size = 0
+        oldtimeout = ser.timeout
+        try:
+            while True:
+                remaining = deadline - _monotonic()
+                if remaining <= 0:
+                    break
+                if background:
+                    remaining = min(remaining, 0.05)
+                ser.timeout = remaining
+                chunk = ser.read(max(1, ser.inWaiting()))
+                if not chunk and not background:
+                    break
+                size += len(chunk)
+                found = parser.feed(chunk)
+                if not background:
+                    for (o, i) in found:
+                        self._notify('status', o, i)
+                if lastoutput in [o for (o, i) in found]:
+                    break
+                if background and self._pending:
+                    logging.debug("status polling interrupted")
+                    # (the rest is read before the next command)
+                    self._unfinishedStatus = (parser, deadline)
+                    break
+        finally:
+            ser.timeout = oldtimeout
+        elapsed = _monotonic() - start
+        self.stats['readtime'] = elapsed
+        logging.debug("read %d status bytes in %s seconds"
+                      % (size, elapsed))
+        return parser.routes
+
+    def _drainStatus(self):
+        # after an interrupted poll, the device may still be sending the
+        # rest of its status: read it (until the last output has been
+        # reported, the line has been quiet for a while, or the status
+        # request has timed out), so that it is neither taken for a reply
+        # to the next command nor talked over by it
+        if self._unfinishedStatus is None:
+            return
+        (parser, deadline) = self._unfinishedStatus
+        self._unfinishedStatus = None
+        ser = self.serial
+        lastoutput = self.numOutputs - 1
+        oldtimeout = ser.timeout
+        try:
+            while True:
+                remaining = deadline - _monotonic()
+                if remaining <= 0:
+                    break
+                ser.timeout = min(remaining, _STATUS_QUIET)
+                chunk = ser.read(max(1, ser.inWaiting()))
+                if not chunk:
+                    break
+                if lastoutput in [o for (o, i) in parser.feed(chunk)]:
+                    break
+        finally:
+            ser.timeout = oldtimeout
+        self.stats['drained'] += 1
+        logging.debug("drained an interrupted status reply")
+
+    def _readRoutes(self, background=False):
+        command = 'm\r'
+        d = self.send(command,
+                      lambda: self._readStatus(background=background)) or {}
+        if d:
+            self._missedReplies = 0
+            self._routes.update(d)
+        elif self.serial and not (background and self._pending):
+            self._missedReplies += 1
+            if self._missedReplies >= self.maxMissedReplies:
+                raise serial.SerialException("no reply from '%s'"
+                                             % (self._linkDevice))
+        if not [o for o in range(self.numOutputs) if o not in d]:
+            self._routesTime = _monotonic()
+        return d
+
+    def _poll(self):
+        # reads the routes in the background, and reports all outputs
+        # that have changed without us knowing
+        self.stats['polls'] += 1
+        old = dict(self._routes)
+        d = self._readRoutes(True)
+        if [o for o in range(self.numOutputs) if o not in d]:
+            # incomplete (or interrupted): the device might still be talking
+            self._replied = False
+        for o in sorted(d):
+            if o not in old:
+                self._notify('status', o, d[o])
+            elif old[o] != d[o]:
+                logging.info("output %s changed externally: %s -> %s"
+                             % (o, old[o], d[o]))
+                self.externalChanges.append((time.time(), o, old[o], d[o]))
+                self.stats['externalchanges'] += 1
+                self._notify('external', o, d[o])
+
+    def _fetchRoutes(self, mode=ROUTES_FORCE):
+        if not self.serial:
+            return None
+        if self._cacheValid(mode):
+            self.stats['cachehits'] += 1
+            d = dict(self._routes)
+        else:
+            self.stats['cachemisses'] += 1
+            d = self._readRoutes()
+        if d:
+            self._notify('routes', d)
+        return d
+
+    def getRoutes(self, timeout=None, mode=ROUTES_FORCE):
+        # gets all outputs with their selected inputs (as a dictionary)
+        # blocks until the matrix has answered
+        return self.fetchRoutes(mode).wait(timeout)
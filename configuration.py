@@ -0,0 +1,193 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014-2015, IOhannes m zmölnig, IEM
+
+# This file is part of DVImatrix848
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DVImatrix848.  If not, see <http://www.gnu.org/licenses/>.
+
+# reading the configuration (setup.json),
+# shared by the GUI and the command line tools.
+# this module must not depend on Qt.
+
+import os
+import json
+import shlex
+
+import deviceprofiles
+from communicator import _outputName, _outputNumber
+
+
+def _getAppDataDir():
+    appdatadir = []
+    if os.name == 'nt':
+        from win32com.shell import shellcon, shell
+        appdatadir += [shell.SHGetFolderPath(0, shellcon.CSIDL_APPDATA, 0, 0)]
+    appdatadir += [
+        os.path.join(os.path.expanduser("~"), ".config")
+        ]
+    for ad in appdatadir:
+        if os.path.exists(ad):
+            ad = os.path.join(ad, "iem.at", "DVImatrix848")
+            try:
+                os.makedirs(ad)
+            except OSError:
+                pass
+            if os.path.isdir(ad):
+                return ad
+    return None
+
+
+def getConfigFile():
+    appdatadir = _getAppDataDir()
+    if not appdatadir:
+        return
+    return os.path.join(appdatadir, "setup.json")
+
+
+def loadConfig(configfile):
+    # raises IOError/ValueError if the file cannot be read
+    with open(configfile, 'rb') as cf:
+        return json.load(cf)
+
+
+def getMatrices(config):
+    # the configurations of all units:
+    # several units are configured in a 'matrices' list;
+    # a single one lives at the top level of the configuration
+    if not isinstance(config, dict):
+        return [{}]
+    matrices = config.get('matrices')
+    if not isinstance(matrices, list) or not matrices:
+        matrices = [config]
+    return [d if isinstance(d, dict) else {} for d in matrices]
+
+
+def getMatrixName(config, index, count):
+    # the name of the 'index'th of 'count' units
+    name = config.get('name')
+    if not name and count > 1:
+        name = "Matrix #%d" % (index + 1)
+    return name
+
+
+def getEmergencySlot(config, default=9):
+    # the routing state slot of the devices reserved for the emergency
+    # routing ('generic/emergencyslot'), None if there is none
+    generic = config.get('generic') if isinstance(config, dict) else None
+    if not isinstance(generic, dict) or 'emergencyslot' not in generic:
+        return default
+    slot = generic['emergencyslot']
+    if slot in range(10):
+        return slot
+    return None
+
+
+def getProfile(config):
+    # the deviceProfile of a unit
+    # raises KeyError (unknown model), TypeError or ValueError
+    return deviceprofiles.getProfile(config.get('model'),
+                                     config.get('outputs'),
+                                     config.get('inputs'))
+
+
+def configureCommunicator(comm, serialconf):
+    # applies the 'serial' section of a unit to its communicator
+    # (settings that are not configured keep their current value)
+    # raises TypeError or AttributeError if the section is malformed
+    d = serialconf
+    comm.sleepTime = d.get('sleep', comm.sleepTime)
+    comm.useAck = bool(d.get('ack', comm.useAck))
+    comm.echo = bool(d.get('echo', comm.echo))
+    comm.ackGap = d.get('ackgap', comm.ackGap)
+    comm.connectDelay = d.get('connectdelay', comm.connectDelay)
+    comm.cacheTime = d.get('cachetime', comm.cacheTime)
+    comm.setPollInterval(d.get('pollinterval', comm.pollInterval))
+
+
+def readRoutes(d, profile):
+    # fix the keys: we want int, not strings
+    # (and drop anything the device does not have)
+    routes = {}
+    for k in d:
+        try:
+            o = int(k)
+        except (ValueError):
+            continue
+        if o in range(profile.outputs) and d[k] in range(profile.inputs):
+            routes[o] = d[k]
+    return routes
+
+
+def parseOutput(s, labels, count):
+    # 'B', '2' or the label of the 2nd output -> 1
+    # raises ValueError for anything that is not one of 'count' outputs
+    if s in labels:
+        o = labels.index(s)
+    elif s.isdigit():
+        o = int(s) - 1
+    elif s.isalpha() and s.isupper():
+        o = _outputNumber(s)
+    else:
+        o = -1
+    if o not in range(count):
+        raise ValueError("unknown output '%s'" % (s))
+    return o
+
+
+def parseInput(s, labels, count):
+    # '3' or the label of the 3rd input -> 2
+    # raises ValueError for anything that is not one of 'count' inputs
+    if s in labels:
+        i = labels.index(s)
+    elif s.isdigit():
+        i = int(s) - 1
+    else:
+        i = -1
+    if i not in range(count):
+        raise ValueError("unknown input '%s'" % (s))
+    return i
+
+
+def formatRoutes(routes, name=None):
+    # {0: 0, 1: 2} -> 'A=1 B=3' (prefixed with the 'name' of the matrix)
+    s = ' '.join(['%s=%d' % (_outputName(o), routes[o] + 1)
+                  for o in sorted(routes)])
+    if name:
+        s = '%s: %s' % (name, s)
+    return s
+
+
+# the commands understood by the running application:
+# {command: number of arguments} (each optionally followed by a matrix)
+COMMANDS = {'activate': 0, 'restore': 0, 'get': 0, 'route': 2, 'apply': 1}
+
+
+def parseCommand(msg, commands=COMMANDS):
+    # 'route B "Cam 2" Stage' -> ('route', ['B', 'Cam 2'], 'Stage')
+    # (the matrix is None if it is not given)
+    # raises ValueError if 'msg' is none of the 'commands'
+    args = [x.decode('utf-8') for x in shlex.split(msg.encode('utf-8'))]
+    if not args:
+        raise ValueError("empty command")
+    (cmd, args) = (args[0], args[1:])
+    if cmd not in commands:
+        raise ValueError("unknown command '%s'" % (cmd))
+    if len(args) not in [commands[cmd], commands[cmd] + 1]:
+        raise ValueError("wrong number of arguments for '%s'" % (cmd))
+    matrix = None
+    if len(args) > commands[cmd]:
+        matrix = args.pop()
+    return (cmd, args, matrix)
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014-2015, IOhannes m zmölnig, IEM
+
+# This file is part of DVImatrix848
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DVImatrix848.  If not, see <http://www.gnu.org/licenses/>.
+
+# the dimensions (and derived properties) of the supported Gefen matrices.
+# all models speak the same protocol; they only differ in the number of
+# outputs (named 'A', 'B',... 'Z', 'AA',...) and inputs (1, 2,...).
+# this module must not depend on Qt.
+
+# the time it takes to transmit a single byte at 19200 baud (8N1)
+BYTETIME = 10. / 19200
+# size of the status reply: the echoed command plus a header line...
+_STATUS_HEADER = len('m\r**** MATRIX STATUS ****\r')
+# ...and a 'MonA: {DviIn=1 , Hpd=0 , ...}' record per output
+# (slightly more for multi-letter outputs and multi-digit inputs)
+_STATUS_RECORD = len('MonA: {DviIn=1 , Hpd=0 , DviOutEn=0 , InDDC=1 ,'
+                     ' DDC-Master=0 PreEmphasis=0 [db]}\r')
+
+
+class deviceProfile(object):
+    def __init__(self, name, outputs, inputs, presets=10):
+        # presets: number of routing states (#PSASRS/S<id>) the device
+        #          can hold; 0 if they cannot be used
+        super(deviceProfile, self).__init__()
+        self.name = name
+        self.outputs = outputs
+        self.inputs = inputs
+        if outputs > 18:
+            # the 'S<id>' shortcut is indistinguishable from
+            # switching output 'S'
+            presets = 0
+        self.presets = presets
+
+    def __repr__(self):
+        return "deviceProfile(%r, %d, %d)" % (self.name,
+                                              self.outputs, self.inputs)
+
+    def statusSize(self):
+        # the expected size (in bytes) of the reply to 'm'
+        record = _STATUS_RECORD
+        if self.outputs > 26:
+            record += 1
+        if self.inputs > 9:
+            record += 2
+        return _STATUS_HEADER + self.outputs * record
+
+    def statusTime(self):
+        # the time it takes to transmit the status reply
+        return self.statusSize() * BYTETIME
+
+    def statusTimeout(self):
+        # how long to wait for the complete status reply
+        # (the time on the wire, plus some slack for the device)
+        return max(1., 1.5 * self.statusTime() + 0.25)
+
+
+_PROFILES = [
+    deviceProfile('EXT-DVI-444', 4, 4),
+    deviceProfile('EXT-DVI-848', 8, 8),
+    deviceProfile('EXT-DVI-16416', 16, 16),
+    # 32x32 (or several cascaded 16x16 units)
+    deviceProfile('GEF-DVI-32432', 32, 32),
+    ]
+PROFILES = dict([(p.name, p) for p in _PROFILES])
+DEFAULT = 'EXT-DVI-848'
+
+
+def getProfile(name=None, outputs=None, inputs=None):
+    # returns the profile for the model 'name' (DEFAULT if None),
+    # with the number of outputs/inputs overridden (e.g. for cascaded units)
+    # raises KeyError for unknown models
+    if name is None:
+        name = DEFAULT
+    profile = PROFILES[name]
+    if outputs is None and inputs is None:
+        return profile
+    if outputs is None:
+        outputs = profile.outputs
+    if inputs is None:
+        inputs = profile.inputs
+    return deviceProfile(profile.name, int(outputs), int(inputs),
+                         profile.presets)
+
+
+if __name__ == '__main__':
+    for p in _PROFILES:
+        print("%-15s %2dx%-2d presets=%2d status=%5d bytes (%.2fs)"
+              % (p.name, p.outputs, p.inputs, p.presets,
+                 p.statusSize(), p.statusTime()))
@@ -0,0 +1,387 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014-2015, IOhannes m zmölnig, IEM
+
+# This file is part of DVImatrix848
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DVImatrix848.  If not, see <http://www.gnu.org/licenses/>.
+
+# controlling the matrices via HTTP/JSON (e.g. from control-room scripts)
+#    GET  /matrix                   all routes of all matrices
+#    GET  /matrix/<m>               {"A": 1, "B": 3, ...}
+#    PUT  /matrix/<m>               {"B": 3, "C": "Cam"} (a single transaction)
+#    GET  /matrix/<m>/<output>      {"output": "B", "input": 3}
+#    PUT  /matrix/<m>/<output>      {"input": 3}
+#    GET  /presets                  the presets of all matrices
+#    POST /presets/<name>           apply a preset (to all matrices having it)
+#    POST /restore                  restore the emergency routing
+#    POST /batch                    [{"matrix": <m>, "routes": {...}},
+#                                    {"matrix": <m>, "preset": <name>},
+#                                    {"matrix": <m>, "restore": true}]
+#    GET  /status                   port and link state of all matrices
+# <m> is the name or the number of a matrix; outputs and inputs are given
+# as letter/number or by their label.
+# 'POST /presets/<name>' and 'POST /restore' take an optional '?matrix=<m>'.
+# GET /matrix... takes '?fresh=1' to ask the devices rather than the cache.
+# changes fail with 503 while the serial link of a matrix is not up.
+#
+# the server runs in its own threads, and only talks to the communicators
+# (so it never blocks the GUI).
+# it can also be run on its own (for the matrices in setup.json):
+#    httpapi.py -c setup.json -l 127.0.0.1:8848
+# this module must not depend on Qt.
+
+import json
+import logging
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+import configuration
+from communicator import _outputName, ROUTES_REVALIDATE, ROUTES_FORCE
+from communicator import LINK_UP
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8848
+
+
+class apiError(Exception):
+    def __init__(self, code, message):
+        super(apiError, self).__init__(message)
+        self.code = code
+
+
+class matrixAPI(object):
+    # the operations of the API on 'units':
+    # anything with 'name', 'comm', 'inputs', 'outputs', 'presets',
+    # 'routes(key)' and 'slot(key)' (like the GUI's matrixUnit or the
+    # cliUnit)
+    def __init__(self, units, timeout=5.):
+        super(matrixAPI, self).__init__()
+        self.units = units
+        # how long (in seconds) to wait for the devices
+        self.timeout = timeout
+
+    def key(self, unit):
+        # how a unit is called in the API
+        return unit.name or str(self.units.index(unit) + 1)
+
+    def selectUnits(self, key=None):
+        if key is None:
+            return list(self.units)
+        for idx, unit in enumerate(self.units):
+            if key in [str(idx + 1), unit.name]:
+                return [unit]
+        raise apiError(404, "no such matrix '%s'" % (key))
+
+    def _routes(self, routes):
+        # {0: 2} -> {'A': 3}
+        return dict([(_outputName(o), i + 1) for (o, i) in routes.items()])
+
+    def _output(self, unit, s):
+        return configuration.parseOutput(unicode(s), unit.outputs,
+                                         unit.comm.profile.outputs)
+
+    def _input(self, unit, s):
+        return configuration.parseInput(unicode(s), unit.inputs,
+                                        unit.comm.profile.inputs)
+
+    def parseRoutes(self, unit, d):
+        # {'B': 3, 'C': 'Cam'} -> {1: 2, 2: <index of 'Cam'>}
+        if not isinstance(d, dict):
+            raise ValueError("routes must be an object")
+        return dict([(self._output(unit, o), self._input(unit, d[o]))
+                     for o in d])
+
+    def getRoutes(self, units, fresh=False):
+        # the routes of all 'units' (asking them in parallel)
+        mode = ROUTES_FORCE if fresh else ROUTES_REVALIDATE
+        requests = [(unit, unit.comm.fetchRoutes(mode)) for unit in units]
+        result = {}
+        for (unit, req) in requests:
+            routes = req.wait(self.timeout)
+            if routes is None:
+                routes = unit.comm.cachedRoutes()
+            result[self.key(unit)] = self._routes(routes)
+        return result
+
+    def getRoute(self, unit, output, fresh=False):
+        o = self._output(unit, output)
+        routes = self.getRoutes([unit], fresh)[self.key(unit)]
+        return {'output': _outputName(o),
+                'input': routes.get(_outputName(o))}
+
+    def presets(self, unit):
+        return dict([(name, self._routes(unit.routes(name)))
+                     for name in unit.presets])
+
+    def status(self, unit):
+        return {'port': unit.comm.getDevice(),
+                'model': unit.comm.profile.name,
+                'link': unit.comm.getLinkState()}
+
+    def _checkLinks(self, units):
+        # without a link, changes would only be remembered for later
+        for unit in units:
+            if unit.comm.getLinkState() != LINK_UP:
+                raise apiError(503, "link down on matrix '%s'"
+                               % (self.key(unit)))
+
+    def namedJobs(self, units, key):
+        # the jobs for applying the named routing 'key' to 'units'
+        return [(unit, unit.routes(key), unit.slot(key)) for unit in units]
+
+    def _recall(self, unit, slot, routes):
+        # applies 'routes' via the routing state 'slot' (if possible)
+        try:
+            unit.comm.restorePreset(slot, routes)
+            return True
+        except (KeyError, ValueError) as e:
+            logging.info("cannot use routing state %s: %s" % (slot, e))
+        return False
+
+    def transaction(self, jobs):
+        # applies all 'jobs' ([(unit, routes)] or [(unit, routes, slot)])
+        # at once: each unit gets a single setRoutes() (only switching the
+        # outputs that differ), or recalls the routing state 'slot'
+        # (if it is not None); all units work in parallel
+        # returns the resulting routes of the units
+        units = []
+        for job in jobs:
+            if job[0] not in units:
+                units += [job[0]]
+        self._checkLinks(units)
+        for job in jobs:
+            (unit, routes, slot) = (tuple(job) + (None,))[:3]
+            if slot is None or not self._recall(unit, slot, routes):
+                unit.comm.setRoutes(routes)
+        for unit in units:
+            if not unit.comm.sync(self.timeout):
+                raise apiError(504, "timeout on matrix '%s'"
+                               % (self.key(unit)))
+        # (the link might have broken in the meantime)
+        self._checkLinks(units)
+        return dict([(self.key(unit), self._routes(unit.comm.cachedRoutes()))
+                     for unit in units])
+
+    def batch(self, ops):
+        # 'ops' is a list of {"matrix": <m>, "routes": {...}},
+        # {"matrix": <m>, "preset": <name>} or {"matrix": <m>,
+        # "restore": true}; all of them are checked before anything is
+        # sent, and all changes to a matrix become a single transaction
+        if not isinstance(ops, list):
+            raise ValueError("batch must be a list")
+        jobs = {}
+        order = []
+        for op in ops:
+            if not isinstance(op, dict):
+                raise ValueError("batch entries must be objects")
+            for unit in self.selectUnits(op.get('matrix')):
+                slot = None
+                if 'routes' in op:
+                    routes = self.parseRoutes(unit, op['routes'])
+                elif 'preset' in op:
+                    routes = unit.routes(op['preset'])
+                elif op.get('restore'):
+                    routes = unit.routes('defaultmatrix')
+                    slot = unit.slot('defaultmatrix')
+                else:
+                    raise ValueError("nothing to do in %s" % (op,))
+                if unit not in jobs:
+                    jobs[unit] = [{}, slot]
+                    order += [unit]
+                else:
+                    # (a slot only holds a single routing)
+                    jobs[unit][1] = None
+                jobs[unit][0].update(routes)
+        return self.transaction([(unit, ) + tuple(jobs[unit])
+                                 for unit in order])
+
+
+class apiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    server_version = "DVImatrix848"
+
+    def log_message(self, format, *args):
+        logging.info("HTTP %s: %s" % (self.client_address[0],
+                                      format % args))
+
+    def _reply(self, code, data):
+        body = json.dumps(data, sort_keys=True)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        size = int(self.headers.getheader('Content-Length') or 0)
+        if not size:
+            return None
+        try:
+            return json.loads(self.rfile.read(size))
+        except ValueError as e:
+            raise apiError(400, "invalid JSON: %s" % (e))
+
+    def _handle(self, method):
+        url = urlparse.urlparse(self.path)
+        path = [urlparse.unquote(p).decode('utf-8')
+                for p in url.path.split('/') if p]
+        query = dict([(k, v[-1].decode('utf-8')) for (k, v)
+                      in urlparse.parse_qs(url.query).items()])
+        try:
+            self._reply(200, self._dispatch(method, path, query))
+        except apiError as e:
+            self._reply(e.code, {'error': '%s' % (e)})
+        except KeyError as e:
+            self._reply(404, {'error': '%s' % (e.args[0] if e.args else e)})
+        except (ValueError, TypeError) as e:
+            self._reply(400, {'error': '%s' % (e)})
+
+    def _dispatch(self, method, path, query):
+        api = self.server.api
+        fresh = query.get('fresh') not in [None, '', '0', 'false']
+        what = path[0] if path else None
+        args = path[1:]
+        if what == 'matrix' and method == 'GET':
+            if not args:
+                return api.getRoutes(api.units, fresh)
+            unit = api.selectUnits(args[0])[0]
+            if len(args) == 1:
+                return api.getRoutes([unit], fresh)[api.key(unit)]
+            if len(args) == 2:
+                return api.getRoute(unit, args[1], fresh)
+        elif what == 'matrix' and method in ['PUT', 'POST'] and args:
+            unit = api.selectUnits(args[0])[0]
+            body = self._body()
+            if len(args) == 1:
+                routes = api.parseRoutes(unit, body)
+            elif len(args) == 2:
+                if isinstance(body, dict):
+                    body = body.get('input')
+                routes = api.parseRoutes(unit, {args[1]: body})
+            else:
+                raise apiError(404, "no such resource")
+            return api.transaction([(unit, routes)])
+        elif what == 'presets' and method == 'GET' and not args:
+            return dict([(api.key(u), api.presets(u)) for u in api.units])
+        elif what == 'presets' and method in ['PUT', 'POST'] and args:
+            units = [u for u in api.selectUnits(query.get('matrix'))
+                     if args[0] in u.presets]
+            if not units:
+                raise apiError(404, "no preset '%s'" % (args[0]))
+            return api.transaction(api.namedJobs(units, args[0]))
+        elif what == 'restore' and method in ['PUT', 'POST'] and not args:
+            units = api.selectUnits(query.get('matrix'))
+            return api.transaction(api.namedJobs(units, 'defaultmatrix'))
+        elif what == 'batch' and method == 'POST' and not args:
+            return api.batch(self._body())
+        elif what == 'status' and method == 'GET' and not args:
+            return dict([(api.key(u), api.status(u)) for u in api.units])
+        raise apiError(404, "no such resource")
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class apiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, api, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), apiHandler)
+        self.api = api
+        self._thread = None
+
+    def start(self):
+        # serves in the background
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='httpapi')
+        self._thread.daemon = True
+        self._thread.start()
+        logging.info("HTTP API on http://%s:%s/" % self.server_address[:2])
+
+    def stop(self):
+        if self._thread:
+            self.shutdown()
+            self._thread = None
+        self.server_close()
+
+
+def parseAddress(s, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    # '8848', 'localhost' or '0.0.0.0:8848' -> (host, port)
+    if s is None:
+        return (host, port)
+    s = str(s)
+    if ':' in s:
+        (host, port) = s.rsplit(':', 1)
+    elif s.isdigit():
+        port = s
+    else:
+        host = s
+    return (host, int(port))
+
+
+def parseCmdlineArgs():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="control the EXT-DVI-848 matrices configured"
+        " in setup.json via HTTP/JSON (without a GUI)")
+    parser.add_argument('-c', '--config', type=str,
+                        help="Configuration file to read")
+    parser.add_argument('-l', '--listen', type=str,
+                        help="[host:]port to listen on (DEFAULT: %s:%s)"
+                        % (DEFAULT_HOST, DEFAULT_PORT))
+    parser.add_argument('-v', '--verbose', action='count',
+                        help="raise verbosity", default=0)
+    parser.add_argument('-q', '--quiet', action='count',
+                        help="lower verbosity", default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    import sys
+    from DVImatrix848cli import getUnits
+    args = parseCmdlineArgs()
+    loglevel = max(0,
+                   min(logging.FATAL,
+                       logging.WARNING+(args.quiet-args.verbose)*10))
+    logging.basicConfig(level=loglevel)
+    try:
+        units = getUnits(args.config or configuration.getConfigFile())
+        server = apiServer(matrixAPI(units), *parseAddress(args.listen))
+    except (IOError, ValueError) as e:
+        logging.error("%s" % (e))
+        sys.exit(1)
+    except KeyError as e:
+        logging.error("%s" % (e.args[0] if e.args else e))
+        sys.exit(1)
+    for unit in units:
+        if unit.port:
+            unit.comm.connect(unit.port)
+    print("serving on http://%s:%s/" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    for unit in units:
+        unit.comm.close()
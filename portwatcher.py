@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014-2015, IOhannes m zmölnig, IEM
+
+# This file is part of DVImatrix848
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DVImatrix848.  If not, see <http://www.gnu.org/licenses/>.
+
+# watching serial ports come and go (e.g. USB-serial adapters),
+# in a background thread.
+# listeners only get told about the ports that have been added/removed.
+# on linux, udev events (via pyudev, if available) trigger a rescan;
+# otherwise the ports are polled.
+# this module must not depend on Qt.
+
+import time
+import threading
+import logging
+
+import serial.tools.list_ports
+
+try:
+    import pyudev
+except ImportError:
+    pyudev = None
+
+
+def listPorts():
+    # the available serial ports: {name: (name, description, hwid)}
+    ports = {}
+    for p in serial.tools.list_ports.comports():
+        ports[p[0]] = (p[0], p[1], p[2])
+    return ports
+
+
+def _udevMonitor():
+    # a (started) udev monitor for tty devices, or None
+    if not pyudev:
+        return None
+    try:
+        monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+        monitor.filter_by('tty')
+        monitor.start()
+        return monitor
+    except (ImportError, EnvironmentError, ValueError) as e:
+        logging.info("cannot watch udev: %s" % (e))
+    return None
+
+
+class portWatcher(object):
+    def __init__(self, interval=2.):
+        super(portWatcher, self).__init__()
+        # how often (in seconds) to poll the ports (if there is no udev)
+        self.interval = interval
+        self._ports = {}
+        self._scanned = False
+        self._listeners = []
+        self._cond = threading.Condition()
+        self._rescan = False
+        self._running = False
+        self._thread = None
+
+    def addListener(self, callback):
+        # 'callback(event, *args)' is called (from the watcher thread):
+        # - 'changed', <added>, <removed>
+        #   'added' is a list of (name, description, hwid),
+        #   'removed' a list of names
+        #   (the first scan always reports, even if there are no ports)
+        if callback not in self._listeners:
+            self._listeners += [callback]
+
+    def removeListener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _notify(self, event, *args):
+        for cb in self._listeners:
+            try:
+                cb(event, *args)
+            except Exception as e:
+                logging.exception("listener failed on '%s': %s" % (event, e))
+
+    def ports(self):
+        # the ports as of the last scan: [(name, description, hwid)]
+        with self._cond:
+            return [self._ports[name] for name in sorted(self._ports)]
+
+    def start(self):
+        with self._cond:
+            if self._thread:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run,
+                                            name='portwatcher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            thread = self._thread
+            self._running = False
+            self._thread = None
+            self._cond.notify()
+        if thread:
+            thread.join()
+
+    def rescan(self):
+        # scan the ports now (rather than waiting for an event)
+        with self._cond:
+            self._rescan = True
+            self._cond.notify()
+        self.start()
+
+    def _scan(self):
+        ports = listPorts()
+        with self._cond:
+            old = self._ports
+            self._ports = ports
+        added = [ports[name] for name in sorted(ports) if name not in old]
+        removed = [name for name in sorted(old) if name not in ports]
+        if added or removed or not self._scanned:
+            logging.info("serial ports: +%s -%s"
+                         % ([p[0] for p in added], removed))
+            self._scanned = True
+            self._notify('changed', added, removed)
+
+    def _waitForChange(self, monitor):
+        # blocks until the ports might have changed: a udev event,
+        # a rescan() or (without udev) every 'interval' seconds
+        # returns False once we have been stopped
+        deadline = time.time() + self.interval
+        while True:
+            with self._cond:
+                if not self._running:
+                    return False
+                if self._rescan:
+                    self._rescan = False
+                    return True
+                if not monitor:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return True
+                    self._cond.wait(remaining)
+                    continue
+            # (check back every now and then, for rescan() and stop())
+            if monitor.poll(timeout=0.25):
+                # an adapter comes with a burst of events:
+                # wait until they are over
+                while monitor.poll(timeout=0.1):
+                    pass
+                return True
+
+    def _run(self):
+        monitor = _udevMonitor()
+        if monitor:
+            logging.info("watching serial ports via udev")
+        while True:
+            try:
+                self._scan()
+            except EnvironmentError as e:
+                logging.error("scanning serial ports failed: %s" % (e))
+            if not self._waitForChange(monitor):
+                break
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014-2015, IOhannes m zmölnig, IEM
+
+# This file is part of DVImatrix848
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DVImatrix848.  If not, see <http://www.gnu.org/licenses/>.
+
+# an observable routing ({output: input}):
+# views subscribe to it, and get notified about each output that changes
+# (rather than having to redraw everything).
+# this module must not depend on Qt.
+
+import threading
+
+
+class routingModel(object):
+    def __init__(self, routes=None):
+        super(routingModel, self).__init__()
+        self._routes = {}
+        self._listeners = []
+        self._lock = threading.RLock()
+        if routes:
+            self._routes.update(routes)
+
+    def addListener(self, callback):
+        # 'callback(event, *args)' is called for every change
+        # (from the thread that made the change):
+        # - 'changed' (output, oldinput, newinput)
+        #   oldinput/newinput are None if the output is (now) unknown
+        if callback not in self._listeners:
+            self._listeners += [callback]
+
+    def removeListener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _notify(self, changes):
+        for (o, old, new) in changes:
+            for cb in list(self._listeners):
+                cb('changed', o, old, new)
+
+    def get(self, output, default=None):
+        return self._routes.get(output, default)
+
+    def routes(self):
+        # a copy of the current routing
+        with self._lock:
+            return dict(self._routes)
+
+    def __len__(self):
+        return len(self._routes)
+
+    def __contains__(self, output):
+        return output in self._routes
+
+    def set(self, output, input):
+        # returns True if this was a change
+        return bool(self.update({output: input}))
+
+    def update(self, routes, clear=False):
+        # sets all outputs in 'routes' ({output: input});
+        # if 'clear' is True, all other outputs become unknown
+        # returns the outputs that have actually changed ({output: input},
+        # with None for outputs that became unknown)
+        changes = []
+        with self._lock:
+            if clear:
+                for o in [o for o in self._routes if o not in routes]:
+                    changes += [(o, self._routes.pop(o), None)]
+            for o in routes:
+                old = self._routes.get(o)
+                if old != routes[o]:
+                    self._routes[o] = routes[o]
+                    changes += [(o, old, routes[o])]
+        self._notify(changes)
+        return dict([(o, new) for (o, old, new) in changes])
+
+    def clear(self):
+        return self.update({}, clear=True)
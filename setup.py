@@ -94,6 +94,9 @@ if os.name == 'nt':
         'icon_resources': [(1, "media\DVImatrix848.ico")],
         'script': 'DVImatrix848.py',
         }],
+        console=[{
+        'script': 'DVImatrix848cli.py',
+        }],
         data_files=data_files,
         options={"py2exe": {
             "includes": ['PySide.QtSvg', 'PySide.QtXml'],
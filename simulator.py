@@ -0,0 +1,288 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014-2015, IOhannes m zmölnig, IEM
+
+# This file is part of DVImatrix848
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DVImatrix848.  If not, see <http://www.gnu.org/licenses/>.
+
+# a simulated EXT-DVI-848, sitting on the other end of a pseudo-terminal
+# (so it only works on un*x)
+#
+# use it like:
+#    sim = simulator(settleTime=0.1)
+#    comm.connect(sim.start())
+
+import os
+import re
+import time
+import random
+import select
+import threading
+import logging
+
+from communicator import _getRoutingMatrixUnparsed
+from communicator import _outputName, _outputNumber
+import deviceprofiles
+
+_SWITCH = re.compile(r"^([A-Z]+)([0-9]+)$")
+
+
+class simulator(object):
+    def __init__(self,
+                 outputs=8, inputs=8,
+                 settleTime=0.,
+                 byteDelay=10./19200,
+                 dropRate=0.,
+                 bootTime=0.,
+                 ack=True,
+                 echo=True):
+        # settleTime: after a command, the device ignores all input
+        #             for so many seconds (and only then acknowledges it)
+        # byteDelay: time it takes to send a single byte
+        #            (the default is the time on the wire at 19200 baud)
+        # dropRate: probability that a byte of a reply is lost
+        # bootTime: after start(), the device ignores all input
+        #           for so many seconds
+        # ack: whether the device acknowledges commands (once it has
+        #      settled) by repeating them
+        # echo: whether the device echoes commands right away (before
+        #       settling), like the EXT-DVI-848 does
+        super(simulator, self).__init__()
+        self.outputs = outputs
+        self.inputs = inputs
+        self.settleTime = settleTime
+        self.byteDelay = byteDelay
+        self.dropRate = dropRate
+        self.bootTime = bootTime
+        self.ack = ack
+        self.echo = echo
+
+        self.routes = dict([(o, o % inputs) for o in range(outputs)])
+        self.presets = {}
+        self.stats = {
+            'commands': 0,
+            'ignored': 0,
+            'bytesin': 0,
+            'bytesout': 0,
+            }
+
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+        self._busyUntil = 0
+        # acknowledgements waiting for the device to settle
+        self._timers = []
+
+    def start(self):
+        # opens the pseudo-terminal and starts answering
+        # returns the name of the port to connect to
+        import pty
+        import tty
+        (self._master, self._slave) = pty.openpty()
+        tty.setraw(self._slave)
+        self._running = True
+        self._busyUntil = time.time() + self.bootTime
+        self._thread = threading.Thread(target=self._run, name='simulator')
+        self._thread.daemon = True
+        self._thread.start()
+        return self.port()
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+        self._thread = None
+        for t in self._timers:
+            t.cancel()
+            t.join()
+        self._timers = []
+        for fd in [self._master, self._slave]:
+            if fd is not None:
+                os.close(fd)
+        self._master = None
+        self._slave = None
+
+    def port(self):
+        if self._slave is None:
+            return None
+        return os.ttyname(self._slave)
+
+    def _run(self):
+        buf = ''
+        while self._running:
+            (r, _, _) = select.select([self._master], [], [], 0.1)
+            if not r:
+                continue
+            try:
+                data = os.read(self._master, 1024)
+            except OSError:
+                break
+            self.stats['bytesin'] += len(data)
+            buf += data
+            while '\r' in buf:
+                (line, buf) = buf.split('\r', 1)
+                line = line.strip()
+                if not line:
+                    continue
+                if time.time() < self._busyUntil:
+                    # still booting or settling: the command is lost
+                    logging.debug("simulator: ignoring %r" % (line,))
+                    self.stats['ignored'] += 1
+                    continue
+                if self.echo:
+                    self._reply(line)
+                self._reply(self.process(line))
+
+    def process(self, line):
+        # executes a single command, and returns the reply
+        logging.debug("simulator: %r" % (line,))
+        self.stats['commands'] += 1
+        reply = None
+        if line in ['m', 'M']:
+            status = _getRoutingMatrixUnparsed(self.routes)
+            if self.echo:
+                # (the 'm' has already been echoed)
+                status = status.split('\r', 1)[1]
+            return status
+        if line.startswith('#'):
+            reply = self._function(line[1:].split())
+        elif line[0] in 'sS' and line[1:].isdigit() and self.outputs <= 18:
+            # recall routing state
+            routes = self.presets.get(int(line[1:]))
+            if routes:
+                self.routes = dict(routes)
+                reply = line
+        else:
+            match = _SWITCH.match(line)
+            if match:
+                o = _outputNumber(match.group(1))
+                i = int(match.group(2)) - 1
+                if o < self.outputs and 0 <= i < self.inputs:
+                    self.routes[o] = i
+                    reply = line
+        if reply is None:
+            logging.debug("simulator: unknown command %r" % (line,))
+            return None
+        if not self.ack:
+            reply = None
+        if self.settleTime > 0:
+            # acknowledge once we have settled
+            self._busyUntil = time.time() + self.settleTime
+            if reply is not None:
+                t = threading.Timer(self.settleTime, self._reply, [reply])
+                t.daemon = True
+                t.start()
+                self._timers = [x for x in self._timers if x.is_alive()]
+                self._timers += [t]
+            return None
+        return reply
+
+    def _function(self, args):
+        try:
+            fun = args[0].upper()
+            if fun == 'PSASRS':
+                id = int(args[1])
+                inputs = [int(x) - 1 for x in args[2:2+self.outputs]]
+                if len(inputs) != self.outputs or id not in range(10):
+                    return None
+                self.presets[id] = dict(enumerate(inputs))
+                return ' '.join(args)
+            if fun == 'MSASRS':
+                id = int(args[1])
+                if id not in range(10):
+                    return None
+                self.presets[id] = dict(self.routes)
+                return ' '.join(args)
+            if fun == 'PRRS':
+                lines = []
+                for id in sorted(self.presets):
+                    routes = self.presets[id]
+                    lines += ['State%d: %s' % (id, ' '.join(
+                        ['%s=%d' % (_outputName(o), routes[o] + 1)
+                         for o in sorted(routes)]))]
+                return '\r'.join([' '.join(args)] + lines)
+        except (IndexError, ValueError):
+            pass
+        return None
+
+    def _reply(self, reply):
+        if reply is None or self._master is None:
+            return
+        data = reply + '\r\n'
+        if self.dropRate:
+            data = ''.join([c for c in data
+                            if random.random() >= self.dropRate])
+        if self.byteDelay:
+            # send in small chunks, so the reader sees the data trickling in
+            chunksize = max(1, int(0.005 / self.byteDelay))
+            for idx in range(0, len(data), chunksize):
+                chunk = data[idx:idx+chunksize]
+                os.write(self._master, chunk)
+                self.stats['bytesout'] += len(chunk)
+                time.sleep(self.byteDelay * len(chunk))
+        else:
+            os.write(self._master, data)
+            self.stats['bytesout'] += len(data)
+
+
+def parseCmdlineArgs():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="simulate an EXT-DVI-848 on a pseudo-terminal")
+    parser.add_argument('-m', '--model', type=str,
+                        default=deviceprofiles.DEFAULT,
+                        choices=sorted(deviceprofiles.PROFILES),
+                        help="model to simulate (DEFAULT: %(default)s)")
+    parser.add_argument('--outputs', type=int,
+                        help="number of outputs (DEFAULT: from the model)")
+    parser.add_argument('--inputs', type=int,
+                        help="number of inputs (DEFAULT: from the model)")
+    parser.add_argument('--settle', type=float, default=0.,
+                        help="settle time after each command in seconds")
+    parser.add_argument('--byte-delay', type=float, default=10./19200,
+                        help="time to send a single byte in seconds")
+    parser.add_argument('--drop', type=float, default=0.,
+                        help="probability of a byte in a reply getting lost")
+    parser.add_argument('--boot', type=float, default=0.,
+                        help="boot time in seconds")
+    parser.add_argument('--no-ack', action='store_true',
+                        help="do not acknowledge commands")
+    parser.add_argument('--no-echo', action='store_true',
+                        help="do not echo commands right away")
+    parser.add_argument('-v', '--verbose', action='count',
+                        help="raise verbosity", default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parseCmdlineArgs()
+    logging.basicConfig(level=logging.WARNING-args.verbose*10)
+    profile = deviceprofiles.getProfile(args.model, args.outputs, args.inputs)
+    sim = simulator(outputs=profile.outputs, inputs=profile.inputs,
+                    settleTime=args.settle,
+                    byteDelay=args.byte_delay,
+                    dropRate=args.drop,
+                    bootTime=args.boot,
+                    ack=not args.no_ack,
+                    echo=not args.no_echo)
+    print("simulated EXT-DVI-848 on %s" % (sim.start()))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    sim.stop()
@@ -0,0 +1,322 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014-2015, IOhannes m zmölnig, IEM
+
+# This file is part of DVImatrix848
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DVImatrix848.  If not, see <http://www.gnu.org/licenses/>.
+
+# benchmarks for the serial path, run against the simulated device:
+# - route: a single communicator.route()
+# - fetch: a single communicator.getRoutes() (forced readback)
+# - apply: DVImatrix848.setRouting() with a full matrix
+# - restore: DVImatrix848.restore() (with and without hardware slot)
+# - scene: setRoutes() with a full matrix on several units at once
+#          (each with its own communicator)
+#
+# the results can be saved as JSON, to compare them across commits
+# and 'sleepTime' settings.
+
+import os
+import sys
+import time
+import json
+import random
+import logging
+
+_BASEDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, _BASEDIR)
+
+from communicator import communicator, ROUTES_FORCE
+from simulator import simulator
+import deviceprofiles
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    idx = int(round((len(values) - 1) * p / 100.))
+    return values[idx]
+
+
+class _probe(object):
+    # measures the latency of operations, and the traffic they cause
+    def __init__(self, *sims):
+        super(_probe, self).__init__()
+        self.sims = sims
+        self.latencies = []
+        self.commands = 0
+        self.bytes = 0
+
+    def _counters(self):
+        commands = 0
+        bytes = 0
+        for sim in self.sims:
+            s = sim.stats
+            commands += s['commands']
+            bytes += s['bytesin'] + s['bytesout']
+        return (commands, bytes)
+
+    def run(self, fun, *args):
+        (c0, b0) = self._counters()
+        t0 = time.time()
+        fun(*args)
+        t1 = time.time()
+        (c1, b1) = self._counters()
+        self.latencies += [t1 - t0]
+        self.commands += c1 - c0
+        self.bytes += b1 - b0
+
+    def results(self):
+        n = len(self.latencies)
+        total = sum(self.latencies)
+        return {
+            'count': n,
+            'p50': percentile(self.latencies, 50),
+            'p95': percentile(self.latencies, 95),
+            'p99': percentile(self.latencies, 99),
+            'commands_per_op': float(self.commands) / n if n else None,
+            'commands_per_second': self.commands / total if total else None,
+            'bytes_per_op': float(self.bytes) / n if n else None,
+            }
+
+
+def _differentRoutes(routes, outputs=8, inputs=8):
+    # random routes that differ from 'routes' on every output
+    result = {}
+    for o in range(outputs):
+        i = random.randint(0, inputs - 2)
+        if i >= routes.get(o, -1):
+            i += 1
+        result[o] = i
+    return result
+
+
+def benchComm(sim, comm, iterations):
+    results = {}
+    outputs = comm.numOutputs
+    inputs = comm.numInputs
+
+    p = _probe(sim)
+    for _ in range(iterations):
+        o = random.randint(0, outputs - 1)
+        i = _differentRoutes(sim.routes, outputs, inputs)[o]
+        p.run(lambda: comm.route(i, o).wait())
+    results['route'] = p.results()
+
+    p = _probe(sim)
+    for _ in range(iterations):
+        p.run(lambda: comm.getRoutes(mode=ROUTES_FORCE))
+    results['fetch'] = p.results()
+    return results
+
+
+def benchScene(sims, comms, iterations):
+    # the scene is applied to all units at once:
+    # the total time should be that of the slowest unit
+    p = _probe(*sims)
+
+    def apply():
+        for (sim, comm) in zip(sims, comms):
+            comm.setRoutes(_differentRoutes(sim.routes,
+                                            comm.numOutputs,
+                                            comm.numInputs))
+        for comm in comms:
+            comm.sync()
+    for _ in range(iterations):
+        p.run(apply)
+    return {'scene%d' % len(comms): p.results()}
+
+
+def benchGUI(sim, window, app, iterations):
+    results = {}
+    unit = window.units[0]
+    comm = unit.comm
+
+    def settle():
+        comm.sync()
+        app.processEvents()
+
+    p = _probe(sim)
+    for _ in range(iterations):
+        routes = _differentRoutes(sim.routes)
+        p.run(lambda: (unit.setRouting(routes), settle()))
+    results['apply'] = p.results()
+
+    for (name, slot) in [('restore', 9), ('restore_noslot', None)]:
+        window.emergency_slot = slot
+        p = _probe(sim)
+        for _ in range(iterations):
+            unit.defaults.update(_differentRoutes(sim.routes), clear=True)
+            unit.setRouting(_differentRoutes(unit.defaults.routes()))
+            settle()
+            p.run(lambda: (window.restore(), settle()))
+        results[name] = p.results()
+    return results
+
+
+def getGUI():
+    # returns (app, DVImatrix848) or (None, None) if Qt is not available
+    try:
+        from PySide import QtGui
+        import DVImatrix848
+    except ImportError as e:
+        logging.warn("skipping GUI benchmarks: %s" % (e))
+        return (None, None)
+    app = QtGui.QApplication.instance() or QtGui.QApplication(sys.argv)
+    return (app, DVImatrix848)
+
+
+def bench(args, sleepTime):
+    profile = deviceprofiles.getProfile(args.model)
+
+    def newSimulator():
+        return simulator(outputs=profile.outputs, inputs=profile.inputs,
+                         settleTime=args.settle, ack=not args.no_ack,
+                         echo=not args.no_echo)
+
+    def setupCommunicator(comm):
+        comm.sleepTime = sleepTime
+        comm.echo = not args.no_echo
+        comm.ackGap = args.ack_gap
+        return comm
+    sim = newSimulator()
+    port = sim.start()
+    results = {}
+    try:
+        comm = setupCommunicator(communicator(profile=profile))
+        comm.connect(port)
+        # get past the boot delay
+        comm.getRoutes()
+        results.update(benchComm(sim, comm, args.iterations))
+        comm.close()
+
+        (app, gui) = getGUI()
+        if gui and profile.name == deviceprofiles.DEFAULT:
+            # (leave the serial ports of the host alone: no autodetection
+            # taking the simulator away from us, or probing real devices)
+            window = gui.DVImatrix848(
+                configfile=os.devnull,
+                fetchMatrix=gui.FETCHMATRIX_NEVER,
+                watchPorts=False)
+            for unit in window.units:
+                unit.autodetect = False
+            comm = setupCommunicator(window.units[0].comm)
+            comm.connect(port)
+            comm.getRoutes()
+            results.update(benchGUI(sim, window, app, args.iterations))
+            comm.close()
+    finally:
+        sim.stop()
+
+    if args.units > 1:
+        sims = [newSimulator() for _ in range(args.units)]
+        comms = []
+        try:
+            for sim in sims:
+                comm = setupCommunicator(communicator(profile=profile))
+                comm.connect(sim.start())
+                comm.getRoutes()
+                comms += [comm]
+            results.update(benchScene(sims[:1], comms[:1], args.iterations))
+            results.update(benchScene(sims, comms, args.iterations))
+        finally:
+            for comm in comms:
+                comm.close()
+            for sim in sims:
+                sim.stop()
+    return results
+
+
+def getCommit():
+    import subprocess
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=_BASEDIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def printResults(sleepTime, results):
+    print("sleepTime=%s" % (sleepTime))
+    for name in sorted(results):
+        r = results[name]
+        print("  %-15s p50=%7.1fms p95=%7.1fms p99=%7.1fms"
+              " %6.1f cmds/s %7.1f bytes/op"
+              % (name,
+                 r['p50'] * 1000, r['p95'] * 1000, r['p99'] * 1000,
+                 r['commands_per_second'] or 0, r['bytes_per_op'] or 0))
+
+
+def parseCmdlineArgs():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="benchmark the serial path against a simulated device")
+    parser.add_argument('-n', '--iterations', type=int, default=20,
+                        help="number of operations per benchmark")
+    parser.add_argument('-s', '--sleep', type=float, action='append',
+                        help="sleepTime(s) of the communicator to benchmark"
+                        " (DEFAULT: 0.25)")
+    parser.add_argument('--settle', type=float, default=0.01,
+                        help="settle time of the simulated device")
+    parser.add_argument('--no-ack', action='store_true',
+                        help="simulated device does not acknowledge commands")
+    parser.add_argument('--no-echo', action='store_true',
+                        help="simulated device does not echo commands right"
+                        " away (and acknowledges with the command itself)")
+    parser.add_argument('--ack-gap', type=float, default=0.,
+                        help="minimum time between an acknowledgement and"
+                        " the next command (DEFAULT: %(default)s)")
+    parser.add_argument('-m', '--model', type=str,
+                        default=deviceprofiles.DEFAULT,
+                        choices=sorted(deviceprofiles.PROFILES),
+                        help="model to simulate (DEFAULT: %(default)s)")
+    parser.add_argument('-u', '--units', type=int, default=4,
+                        help="number of simulated devices for the 'scene'"
+                        " benchmark (DEFAULT: %(default)s)")
+    parser.add_argument('-o', '--output', type=str,
+                        help="write results to this JSON file")
+    parser.add_argument('-v', '--verbose', action='count',
+                        help="raise verbosity", default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parseCmdlineArgs()
+    logging.basicConfig(level=logging.WARNING-args.verbose*10)
+    if not args.sleep:
+        args.sleep = [0.25]
+    report = {
+        'commit': getCommit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'settle': args.settle,
+        'ack': not args.no_ack,
+        'echo': not args.no_echo,
+        'ackgap': args.ack_gap,
+        'iterations': args.iterations,
+        'units': args.units,
+        'model': args.model,
+        'results': {},
+        }
+    for sleepTime in args.sleep:
+        results = bench(args, sleepTime)
+        printResults(sleepTime, results)
+        report['results'][str(sleepTime)] = results
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
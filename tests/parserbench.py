@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014-2015, IOhannes m zmölnig, IEM
+
+# This file is part of DVImatrix848
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DVImatrix848.  If not, see <http://www.gnu.org/licenses/>.
+
+# microbenchmark for the routing status parser
+#
+# compares the current parser with the old line-by-line regex parser
+# on randomly generated status replies
+
+import os
+import sys
+import re
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from communicator import _makeRandomRoutes, _getRoutingMatrixUnparsed
+from communicator import _parseRoutingMatrixString
+
+
+def _parseRoutingMatrixStringOld(s):
+    # the original parser (single-letter outputs only)
+    routes = {}
+    if not s:
+        return routes
+    pat = r"^Mon(?P<output>[A-Z]+): {DviIn=(?P<input>[0-9]+) ,.*}$"
+    for x in s.split('\r'):
+        match = re.search(pat, x)
+        if match:
+            d = match.groupdict()
+            try:
+                routes[ord(d['output'])-65] = int(d['input'])-1
+            except (KeyError, TypeError, ValueError):
+                pass
+    return routes
+
+
+def _addNoise(s, count=4):
+    # sprinkles some stray bytes in front of the records
+    s = s.split('\r')
+    for _ in range(count):
+        idx = random.randint(0, len(s) - 1)
+        s[idx] = '\x00\xff%c%s' % (random.randint(32, 126), s[idx])
+    return '\r'.join(s)
+
+
+def makeCorpus(count, outputs=8, inputs=8, noise=False):
+    corpus = []
+    for _ in range(count):
+        routes = _makeRandomRoutes(outputs, inputs)
+        s = _getRoutingMatrixUnparsed(routes)
+        if noise:
+            s = _addNoise(s)
+        corpus += [(routes, s)]
+    return corpus
+
+
+def bench(parser, corpus, repeat=5):
+    data = [s for (_, s) in corpus]
+
+    def run():
+        for s in data:
+            parser(s)
+    return min(timeit.repeat(run, number=1, repeat=repeat))
+
+
+def check(parser, corpus):
+    # returns the number of replies that were parsed correctly
+    return len([r for (r, s) in corpus if parser(s) == r])
+
+
+def parseCmdlineArgs():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="benchmark the routing status parser")
+    parser.add_argument('-n', '--count', type=int, default=10000,
+                        help="number of status replies per corpus")
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help="number of runs (the fastest one counts)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parseCmdlineArgs()
+    corpora = [
+        ("8x8", makeCorpus(args.count)),
+        ("8x8+noise", makeCorpus(args.count, noise=True)),
+        ("64x64", makeCorpus(args.count // 8, 64, 64)),
+        ]
+    parsers = [
+        ("old", _parseRoutingMatrixStringOld),
+        ("new", _parseRoutingMatrixString),
+        ]
+    for (name, corpus) in corpora:
+        size = sum([len(s) for (_, s) in corpus])
+        results = []
+        for (pname, parser) in parsers:
+            t = bench(parser, corpus, args.repeat)
+            ok = check(parser, corpus)
+            results += [t]
+            print("%-10s %-4s %8.2f MB/s %10.1f replies/s  (%d/%d correct)"
+                  % (name, pname, size / t / 1e6, len(corpus) / t,
+                     ok, len(corpus)))
+        print("%-10s speedup: %.2fx" % (name, results[0] / results[-1]))
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014-2015, IOhannes m zmölnig, IEM
+
+# This file is part of DVImatrix848
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DVImatrix848.  If not, see <http://www.gnu.org/licenses/>.
+
+# regression test (against the simulated device): routes submitted while
+# a poll is reading the status must neither be taken for acknowledged by
+# the rest of the status reply, nor be sent while the device is settling
+# (where they would be lost), and the next poll must not report them
+# as 'external' changes.
+# exits with 0 if all rounds pass.
+
+import os
+import sys
+import time
+import logging
+
+_BASEDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, _BASEDIR)
+
+from communicator import communicator
+from simulator import simulator
+
+
+def run(rounds=5, pollInterval=0.3, settleTime=0.05, sleepTime=0.25):
+    sim = simulator(settleTime=settleTime)
+    comm = communicator(sleepTime=sleepTime)
+    comm.connectDelay = 0
+    failures = 0
+    external = []
+    comm.addListener(lambda event, *args: external.append(args)
+                     if event == 'external' else None)
+    try:
+        comm.connect(sim.start(), True)
+        comm.sync(5)
+        comm.setPollInterval(pollInterval)
+        for n in range(rounds):
+            input = 2 + n % 5
+            ignored = sim.stats['ignored']
+            # wait until a poll has started, and let the status trickle in
+            polls = comm.stats['polls']
+            while comm.stats['polls'] == polls:
+                time.sleep(0.005)
+            time.sleep(0.05)
+            for o in range(3):
+                comm.route(input, o)
+            comm.sync(5)
+            # the acknowledgement of the last route might still be on its way
+            time.sleep(settleTime * 2)
+            routes = [sim.routes[o] for o in range(3)]
+            ignored = sim.stats['ignored'] - ignored
+            ok = routes == [input] * 3 and not ignored and not external
+            print("round %d: sim.routes=%s ignored=%d external=%s %s"
+                  % (n, routes, ignored, external,
+                     "OK" if ok else "FAILED"))
+            del external[:]
+            if not ok:
+                failures += 1
+        print("drained %d interrupted status replies"
+              % (comm.stats['drained']))
+    finally:
+        comm.close()
+        sim.stop()
+    return failures
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    sys.exit(1 if run() else 0)
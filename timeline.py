@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2014-2015, IOhannes m zmölnig, IEM
+
+# This file is part of DVImatrix848
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DVImatrix848.  If not, see <http://www.gnu.org/licenses/>.
+
+# timing the phases of the startup:
+# import this module first, and mark() the end of each phase
+#    from timeline import startup
+#    ...
+#    startup.mark('config')
+# this module must not depend on Qt (or anything else that is slow).
+
+import time
+import logging
+
+
+class timeline(object):
+    def __init__(self, name):
+        super(timeline, self).__init__()
+        self.name = name
+        self.start = time.time()
+        self._last = self.start
+        self.phases = []  # (phase, duration, since start)
+        self._unlogged = []
+
+    def mark(self, phase):
+        # the 'phase' has just ended
+        now = time.time()
+        duration = now - self._last
+        elapsed = now - self.start
+        self._last = now
+        self.phases += [(phase, duration, elapsed)]
+        self._log(logging.INFO, "%s: %-20s %7.1fms (%7.1fms)"
+                  % (self.name, phase, duration * 1000, elapsed * 1000))
+        return elapsed
+
+    def milestone(self, what):
+        # something that users care about has happened
+        # (reported even without raising the verbosity)
+        elapsed = time.time() - self.start
+        self._log(logging.WARNING, "%s: %s after %.1fms"
+                  % (self.name, what, elapsed * 1000))
+        return elapsed
+
+    def _log(self, level, msg):
+        # logging.log() would set up logging (with the default settings)
+        # if that has not been done yet, so we hold the messages back
+        self._unlogged += [(level, msg)]
+        if not logging.root.handlers:
+            return
+        for (level, msg) in self._unlogged:
+            logging.log(level, msg)
+        self._unlogged = []
+
+    def elapsed(self, phase=None):
+        # time since start (until the end of 'phase')
+        for (p, _, elapsed) in self.phases:
+            if p == phase:
+                return elapsed
+        return time.time() - self.start
+
+
+startup = timeline('startup')
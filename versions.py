@@ -18,10 +18,19 @@
 # You should have received a copy of the GNU General Public License
 # along with DVImatrix848.  If not, see <http://www.gnu.org/licenses/>.
 
+# checking for new releases on github:
+# the result is cached on disk (and re-validated with conditional requests),
+# so the check is cheap, and it never blocks for longer than 'timeout'
+# (use checkGithubVersion() to not block at all).
+
 from distutils.version import LooseVersion
 
 import os.path
 import sys
+import json
+import time
+import threading
+import logging
 _SCRIPTDIR = os.path.dirname(os.path.abspath(sys.argv[0]))
 _CACERT = os.path.join(_SCRIPTDIR, 'cacert.pem')
 if not os.path.exists(_CACERT):
@@ -37,6 +46,9 @@ def _stripVersionString(version_string):
 def _getLatestVersion(j):
     v = None
     # print("latest: %s" % (j))
+    if isinstance(j, dict):
+        # (a single release)
+        j = [j]
     for k in j:
         try:
             version_string = _stripVersionString(k['tag_name'])
@@ -54,22 +66,147 @@ def _getLatestVersion(j):
     return None
 
 
-def getGithubVersion(project):
-    import requests
-    url = ("https://api.github.com/repos/%s/releases" % project)
+# how long (secs) a cached release is considered current
+CACHE_TTL = 24 * 60 * 60
+# how long (secs) to wait for github
+TIMEOUT = 5.
+
+_cacheLock = threading.Lock()
+
+
+def _getCacheFile():
     try:
-        r = requests.get(url, verify=_CACERT)
-    except requests.exceptions.ConnectionError:
+        from configuration import _getAppDataDir
+        appdatadir = _getAppDataDir()
+    except ImportError:
         return None
+    if not appdatadir:
+        return None
+    return os.path.join(appdatadir, "versions.json")
+
+
+def _readCache(project):
+    cachefile = _getCacheFile()
+    if not cachefile:
+        return {}
     try:
-        r.raise_for_status()
-    except requests.exceptions.HTTPError:
+        with open(cachefile, 'rb') as f:
+            cache = json.load(f)
+        return cache.get(project) or {}
+    except (IOError, ValueError, AttributeError):
+        return {}
+
+
+def _writeCache(project, entry):
+    cachefile = _getCacheFile()
+    if not cachefile:
+        return
+    with _cacheLock:
+        cache = {}
+        try:
+            with open(cachefile, 'rb') as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            pass
+        if not isinstance(cache, dict):
+            cache = {}
+        cache[project] = entry
+        try:
+            with open(cachefile, 'wb') as f:
+                json.dump(cache, f, indent=4)
+        except IOError as e:
+            logging.info("cannot write %s: %s" % (cachefile, e))
+
+
+def getCachedVersion(project, ttl=None):
+    """
+    returns the last known release of 'project' (without going online),
+    None if it is unknown (or older than 'ttl' seconds)"""
+    entry = _readCache(project)
+    if ttl is not None and time.time() - entry.get('checked', 0) > ttl:
         return None
+    return entry.get('version')
+
+
+def _fetchGithubVersion(project, timeout):
+    try:
+        import requests
+    except ImportError as e:
+        logging.info("cannot check for new releases: %s" % (e))
+        return None
+    url = ("https://api.github.com/repos/%s/releases/latest" % project)
+    entry = _readCache(project)
+    headers = {}
+    # only download the release if it has changed
+    # (validators of another URL do not apply)
+    if entry.get('version') and entry.get('url') == url:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
     try:
-        j = r.json()
-    except ValueError:
+        r = requests.get(url, verify=_CACERT, headers=headers,
+                         timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        logging.info("cannot check for new releases: %s" % (e))
         return None
-    return _getLatestVersion(j)
+    # a 304 need not repeat the validators: keep the ones we have
+    etag = r.headers.get('ETag')
+    last_modified = r.headers.get('Last-Modified')
+    if r.status_code == 304:
+        version = entry.get('version')
+        etag = etag or entry.get('etag')
+        last_modified = last_modified or entry.get('last_modified')
+    else:
+        try:
+            r.raise_for_status()
+        except requests.exceptions.HTTPError:
+            return None
+        try:
+            j = r.json()
+        except ValueError:
+            return None
+        version = _getLatestVersion(j)
+    _writeCache(project, {
+        'version': version,
+        'url': url,
+        'etag': etag,
+        'last_modified': last_modified,
+        'checked': time.time(),
+        })
+    return version
+
+
+def checkGithubVersion(project, callback=None, timeout=TIMEOUT):
+    """
+    checks for the latest release of 'project' in the background;
+    calls 'callback(version)' (from another thread) when done.
+    returns the thread doing the check"""
+    def check():
+        version = _fetchGithubVersion(project, timeout)
+        if callback:
+            callback(version)
+    thread = threading.Thread(target=check)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def getGithubVersion(project, timeout=TIMEOUT, ttl=CACHE_TTL):
+    """
+    returns the latest release of 'project', None if it cannot be determined.
+    uses the cache if it is younger than 'ttl' seconds,
+    and never blocks for longer than 'timeout' seconds"""
+    version = getCachedVersion(project, ttl)
+    if version:
+        return version
+    result = []
+    thread = checkGithubVersion(project, result.append, timeout)
+    thread.join(timeout)
+    if result and result[0]:
+        return result[0]
+    # (an outdated answer is better than none)
+    return getCachedVersion(project)
 
 
 def getCurrentVersion():